@@ -0,0 +1,158 @@
+"""
+site: icourse163.org (离线)
+	description: 基于 replay_server 的下载基准测试，对比不同并发数、块大小、引擎下 batch_download_with_retry 的耗时、吞吐和内存。
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from replay_server import ReplayServer, SyntheticCourse, RecordedCourse
+
+# --- 配置区 ---
+# 每项是一组 batch_download_with_retry 参数；name 为表格里的名字，segment_workers 会设置 test.SEGMENT_WORKERS
+CONFIGS = [
+	{'name': 'thread-w5', 'engine': 'thread', 'max_workers': 5},
+	{'name': 'thread-w10', 'engine': 'thread', 'max_workers': 10},
+	{'name': 'thread-w5-seg16', 'engine': 'thread', 'max_workers': 5, 'segment_workers': 16},
+	{'name': 'thread-w5-chunk64k', 'engine': 'thread', 'max_workers': 5, 'chunk_size': 64 * 1024},
+	{'name': 'thread-w5-mem16m', 'engine': 'thread', 'max_workers': 5, 'memory_budget': 16 * 1024 * 1024},
+	{'name': 'thread-w5-noprefetch', 'engine': 'thread', 'max_workers': 5, 'prefetch_ahead': 0},
+	{'name': 'async-w5', 'engine': 'async', 'max_workers': 5},
+	{'name': 'async-w5-mem16m', 'engine': 'async', 'max_workers': 5, 'memory_budget': 16 * 1024 * 1024},
+]
+# 网络场景：ReplayServer 的延迟/带宽/错误注入参数
+SCENARIOS = {
+	'lan': {},
+	'wan': {'latency': {'rpc': 0.08, 'playlist': 0.04, 'segment': 0.05}, 'jitter': 0.5, 'bandwidth': 4 * 1024 * 1024},
+	'flaky': {'latency': {'rpc': 0.08, 'playlist': 0.04, 'segment': 0.05}, 'jitter': 0.5, 'bandwidth': 4 * 1024 * 1024, 'error_rate': 0.05, 'truncate_rate': 0.02},
+}
+SCENARIO = 'wan'
+# 录制目录；None 时用虚拟课程
+RECORDING_DIR = None
+# 为False时不调用 ffmpeg，下载完的 .ts 直接改名为 .mp4(虚拟课程的分片不是真正的视频，只能这样)
+REMUX = False
+# 每个配置重复次数，取耗时中位数
+REPEAT = 1
+# 结果另存为 JSON lines，None 为不存
+RESULTS_FILE = None
+
+RESULT_PREFIX = "BENCH_RESULT "
+
+def peak_rss():
+	"""进程峰值常驻内存(字节)，取不到时返回 None"""
+	try:
+		import resource
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		# Linux 以 KiB 计，macOS 以字节计
+		return peak if sys.platform == 'darwin' else peak * 1024
+	except ImportError:
+		pass
+	try:
+		import psutil
+		return psutil.Process().memory_info().peak_wset
+	except (ImportError, AttributeError):
+		return None
+
+def run_child(config):
+	"""子进程：连到回放服务器导入 test.py，跑一次 batch_download_with_retry，最后一行输出结果"""
+	target_dir = config.pop('target_dir')
+	remux = config.pop('remux')
+	segment_workers = config.pop('segment_workers', None)
+	t_import = time.perf_counter()
+	import test
+	import_time = time.perf_counter() - t_import
+	if segment_workers:
+		test.SEGMENT_WORKERS = segment_workers
+	if not remux:
+		def copy_remux(ts_path, filepath, manifest=None):
+			os.replace(ts_path, filepath)
+			test.get_ledger(os.path.dirname(filepath)).add(test.video_name(filepath))
+			if manifest:
+				manifest.remove()
+			return True
+		test.remux_ts = copy_remux
+	units = test.load_units(target_dir=target_dir)
+	t0 = time.perf_counter()
+	test.batch_download_with_retry(units, live_view=False, **config)
+	wall = time.perf_counter() - t0
+	done = len(test.get_ledger(target_dir).names())
+	result = {
+		'wall': wall,
+		'import': import_time,
+		'bytes': test.telemetry.bytes_total,
+		'videos': len(units),
+		'completed': done,
+		'retries': sum(test.telemetry.retries.values()),
+		'peak_rss': peak_rss(),
+	}
+	print(RESULT_PREFIX + json.dumps(result))
+
+def run_config(server, config, cookies_file, remux=REMUX):
+	"""在独立子进程里跑一个配置(各配置互不共享缓存和连接)，返回结果字典"""
+	target_dir = tempfile.mkdtemp(prefix="bench_")
+	payload = {k: v for k, v in config.items() if k != 'name'}
+	payload.update(target_dir=target_dir, remux=remux)
+	env = dict(os.environ, **server.env(cookies_file))
+	try:
+		proc = subprocess.run(
+			[sys.executable, os.path.abspath(__file__), "--child", json.dumps(payload)],
+			cwd=os.path.dirname(os.path.abspath(__file__)), env=env, capture_output=True, text=True, encoding='utf-8'
+		)
+	finally:
+		shutil.rmtree(target_dir, ignore_errors=True)
+	for line in reversed(proc.stdout.splitlines()):
+		if line.startswith(RESULT_PREFIX):
+			return json.loads(line[len(RESULT_PREFIX):])
+	tail = (proc.stderr or proc.stdout).strip().splitlines()[-1:]
+	return {'error': tail[0] if tail else f"exit {proc.returncode}"}
+
+def run_benchmark(configs=CONFIGS, scenario=SCENARIO, course=None, repeat=REPEAT, remux=REMUX, results_file=RESULTS_FILE):
+	"""每个配置各起一台新的回放服务器跑 repeat 次，打印对比表并返回结果列表"""
+	course = course or (RecordedCourse(RECORDING_DIR) if RECORDING_DIR else SyntheticCourse())
+	workdir = tempfile.mkdtemp(prefix="bench_cookies_")
+	cookies_file = os.path.join(workdir, "Cookies.json")
+	with open(cookies_file, 'w', encoding='utf-8') as f:
+		json.dump({"NTESSTUDYSI": "replay"}, f)
+	results = []
+	try:
+		for config in configs:
+			runs = []
+			for _ in range(repeat):
+				with ReplayServer(course, seed=len(runs), **SCENARIOS[scenario]) as server:
+					runs.append(run_config(server, config, cookies_file, remux))
+			ok = [r for r in runs if 'error' not in r]
+			if not ok:
+				results.append({'name': config['name'], 'scenario': scenario, 'error': runs[-1]['error']})
+				continue
+			ok.sort(key=lambda r: r['wall'])
+			result = dict(ok[len(ok) // 2], name=config['name'], scenario=scenario, runs=len(ok))
+			result['throughput'] = result['bytes'] / result['wall'] if result['wall'] else 0.0
+			results.append(result)
+	finally:
+		shutil.rmtree(workdir, ignore_errors=True)
+	print(format_results(results))
+	if results_file:
+		with open(results_file, 'a', encoding='utf-8') as f:
+			for result in results:
+				f.write(json.dumps(dict(result, ts=time.time()), ensure_ascii=False) + "\n")
+	return results
+
+def format_results(results):
+	lines = [f"{'配置':<24}{'耗时(s)':>10}{'吞吐(MB/s)':>12}{'峰值内存(MB)':>14}{'完成':>8}{'重试':>6}"]
+	for r in results:
+		if 'error' in r:
+			lines.append(f"{r['name']:<24}失败: {r['error']}")
+			continue
+		rss = f"{r['peak_rss'] / 1048576:.0f}" if r.get('peak_rss') else "-"
+		lines.append(f"{r['name']:<24}{r['wall']:>10.2f}{r['throughput'] / 1048576:>12.2f}{rss:>14}{r['completed']:>5}/{r['videos']:<2}{r['retries']:>6}")
+	return "\n".join(lines)
+
+if __name__ == "__main__":
+	if len(sys.argv) > 2 and sys.argv[1] == "--child":
+		run_child(json.loads(sys.argv[2]))
+	else:
+		run_benchmark()
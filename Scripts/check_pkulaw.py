@@ -0,0 +1,63 @@
+"""
+    description: 用 fixtures/pkulaw 下的样例页面核对 pkulaw.py：按区域解析(strained=True)与解析整页的类型和Markdown输出须完全一致。
+    python check_pkulaw.py，有不一致时以非零状态退出。
+"""
+import io
+import os
+import sys
+
+import pkulaw
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'pkulaw')
+# 样例文件 -> (期望类型, 期望输出文件名, 输出里必须出现的片段)
+EXPECTED = {
+    'paper.html': ('paper', '论合同解除的溯及力.md', ['> 本文讨论合同解除的溯及力问题。', '#### 问题的提出', '| 德国 | 折衷说 |']),
+    'paper_abstract_outside.html': ('paper', '论合同解除的溯及力.md', ['> 本文讨论合同解除的溯及力问题。']),
+    'regulation.html': ('regulation', '2020-10-17 - 测试法.md', ['###### 第二条', '（一）甲；', '| 税目 | 税目 | 税率 |']),
+    'case.html': ('case', '（2020）京01民终1号.md', ['民事案由/合同纠纷/买卖合同纠纷', '##### 本院认为', r'\[见原审判决\]']),
+}
+
+def render(path, strained):
+    doc_type, citation_code, soup, index = pkulaw.load_document(path, strained=strained)
+    if doc_type is None:
+        return None, None, None
+    out = io.StringIO()
+    output_file = pkulaw.PROCESSORS[doc_type](soup, out, index)
+    return doc_type, os.path.basename(output_file), out.getvalue()
+
+def check(name):
+    """返回问题列表，空列表表示通过"""
+    path = os.path.join(FIXTURE_DIR, name)
+    expected_type, expected_file, snippets = EXPECTED[name]
+    problems = []
+    full = render(path, strained=False)
+    strained = render(path, strained=True)
+    if strained != full:
+        problems.append("按区域解析与解析整页的输出不同")
+    doc_type, output_file, markdown = strained
+    if doc_type != expected_type:
+        problems.append(f"类型为 {doc_type}，应为 {expected_type}")
+    if output_file != expected_file:
+        problems.append(f"输出文件名为 {output_file}，应为 {expected_file}")
+    for snippet in snippets:
+        if snippet not in (markdown or ''):
+            problems.append(f"输出中缺少 {snippet!r}")
+    return problems
+
+def main():
+    import bs4
+    print(f"bs4 {bs4.__version__}")
+    failed = 0
+    for name in sorted(EXPECTED):
+        try:
+            problems = check(name)
+        except Exception as e:
+            problems = [f"{type(e).__name__}: {e}"]
+        print(f"{'通过' if not problems else '失败'}  {name}")
+        for problem in problems:
+            print(f"      {problem}")
+        failed += bool(problems)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,6 +6,7 @@ site: douban.com
 
 import re
 from bs4 import BeautifulSoup
+from textnorm import strip_unsafe
 
 def parse_douban_html(html_content):
     """
@@ -130,7 +131,7 @@ if __name__ == "__main__":
         
         if title and markdown_content:
             # 清理文件名中的非法字符
-            safe_title = re.sub(r'[\\/*?:"<>|]', "", title)
+            safe_title = strip_unsafe(title)
             output_md_file = f"E:/CODE/Test/Targets/{safe_title}.md"
             
             with open(output_md_file, 'w', encoding='utf-8') as f:
@@ -3,39 +3,350 @@
 site: pkulaw.com
     description: 自动检测北大法宝导出的HTML类型（论文/法规/案例），并转换为PKB规范的Markdown文件
 """
+import io
 import os
 import re
-from bs4 import BeautifulSoup, NavigableString
+import csv
+import glob
+import json
+import time
+import hashlib
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from bs4 import BeautifulSoup, NavigableString, SoupStrainer, Tag
+try:
+    from bs4.filter import ElementFilter  # bs4 4.13+
+except ImportError:
+    ElementFilter = None
+from textnorm import (
+    DATE_RE, NOTE_MARK_RE, REF_MARK_RE, collapse_whitespace, match_heading, paragraph_breaks,
+    escape_brackets, ref_marks_to_footnotes, safe_filename,
+)
 
 # --- 配置区 ---
 INPUT_HTML_FILE = 'E:/CODE/Test/Files/pkulaw.html'  # 你要处理的HTML文件
 OUTPUT_DIR = 'E:/CODE/Test/Targets/'
+# 批量模式：输入目录或通配符(如 'E:/CODE/Test/Files/**/*.html')，设置后忽略 INPUT_HTML_FILE
+INPUT_DIR = None
+# 批量模式的进程数，None 为CPU核数
+BATCH_WORKERS = None
+# 批量模式下只转换新增或改动过的文件(依据输出目录里的清单)
+INCREMENTAL = True
+# 转换逻辑有变化时加一，清单里旧版本的输出会全部重新生成
+CONVERTER_VERSION = 2
+# 先只在文件开头这么多字符里找引证码定类型
+DETECT_HEAD_CHARS = 64 * 1024
+# 定类型后只解析处理函数用到的区域(标题、元数据栏、正文、参考文献)，为False时解析整页
+STRAINED_PARSE = True
+# 行数不少于 TABLE_EXPORT_MIN_ROWS 的表格另存一份 'csv' 或 'parquet'(需要 pyarrow 或 pandas)到Markdown旁边，None 为不导出
+TABLE_EXPORT = None
+TABLE_EXPORT_MIN_ROWS = 50
+
+JOURNAL_RE = re.compile(r'《[^《》]+》')
+AUTHOR_SPLIT_RE = re.compile(r'[；;\s]+')
+CN_BRACKET_RE = re.compile(r'（([^（）]*?)）')
+EN_BRACKET_RE = re.compile(r'\(([^()]*)\)')
+ISSUER_TITLE_RE = re.compile(r'(.*?[院部会委局厅署])?关于(.*)')
 
 # --- 网页表格转Markdown --- 
-def html_table_to_markdown(table):
+def _span(value):
+    """rowspan/colspan 属性值，缺省或非法时为1"""
+    try:
+        return min(max(int(value), 1), 1000)
+    except (TypeError, ValueError):
+        return 1
+
+def read_table(table):
     """
-    将bs4的<table>节点转为Markdown表格字符串
+    一次遍历<table>，返回每行的 [(文字, rowspan, colspan), ...]。
+    单元格文字等同于 get_text(strip=True)；嵌套表格不单独成行，只作为所在单元格的文字。
+    """
+    rows = []
+    row = None
+    stack = list(reversed(table.contents))
+    while stack:
+        node = stack.pop()
+        if not isinstance(node, Tag):
+            continue
+        if node.name == 'tr':
+            row = []
+            rows.append(row)
+            stack.extend(reversed(node.contents))
+        elif node.name in ('td', 'th'):
+            if row is None:  # 缺了<tr>的单元格
+                row = []
+                rows.append(row)
+            row.append((''.join(node.stripped_strings), _span(node.get('rowspan')), _span(node.get('colspan'))))
+        elif node.name != 'table':
+            stack.extend(reversed(node.contents))
+    return rows
+
+def table_grid(table):
+    """
+    把<table>展开成矩形的文字网格：跨行/跨列的单元格在所覆盖的每一格都填上同样的文字，短行用空串补齐。
+    没有跨行跨列时走快速路径。空表返回 []。
     """
-    rows = table.find_all('tr')
-    if not rows:
+    rows = read_table(table)
+    if all(rowspan == 1 and colspan == 1 for row in rows for _, rowspan, colspan in row):
+        grid = [[text for text, _, _ in row] for row in rows if row]
+    else:
+        grid = []
+        pending = {}  # 列号 -> [还要向下占的行数, 文字]
+        def take(col):
+            entry = pending[col]
+            entry[0] -= 1
+            if not entry[0]:
+                del pending[col]
+            return entry[1]
+        for row in rows:
+            line = []
+            for text, rowspan, colspan in row:
+                while len(line) in pending:
+                    line.append(take(len(line)))
+                for _ in range(colspan):
+                    if rowspan > 1:
+                        pending[len(line)] = [rowspan - 1, text]
+                    line.append(text)
+            # 行尾之后还被上面跨行单元格占着的列
+            for col in sorted(c for c in pending if c >= len(line)):
+                line.extend([''] * (col - len(line)))
+                line.append(take(col))
+            if line:
+                grid.append(line)
+    if not grid:
+        return []
+    width = max(len(line) for line in grid)
+    for line in grid:
+        if len(line) < width:
+            line.extend([''] * (width - len(line)))
+    return grid
+
+def _md_cell(text):
+    if '|' in text:
+        text = text.replace('|', '\\|')
+    if '\n' in text or '\r' in text:
+        text = ' '.join(text.split())
+    return text
+
+def grid_to_markdown(grid):
+    if not grid:
         return ''
-    md_lines = []
-    # 处理表头
-    headers = [cell.get_text(strip=True) for cell in rows[0].find_all(['th', 'td'])]
-    md_lines.append('| ' + ' | '.join(headers) + ' |')
-    md_lines.append('|' + '|'.join([' --- ' for _ in headers]) + '|')
-    # 处理表体
-    for row in rows[1:]:
-        cells = [cell.get_text(strip=True) for cell in row.find_all(['td', 'th'])]
-        md_lines.append('| ' + ' | '.join(cells) + ' |')
+    header = grid[0]
+    md_lines = ['| ' + ' | '.join(map(_md_cell, header)) + ' |', '|' + '|'.join([' --- '] * len(header)) + '|']
+    md_lines.extend('| ' + ' | '.join(map(_md_cell, row)) + ' |' for row in grid[1:])
     return '\n'.join(md_lines)
 
+def html_table_to_markdown(table):
+    """
+    将bs4的<table>节点转为Markdown表格字符串
+    """
+    return grid_to_markdown(table_grid(table))
+
+def _column_names(header):
+    """表头作列名：空的用「列n」，重复的加后缀"""
+    names = []
+    seen = set()
+    for i, name in enumerate(header, 1):
+        name = name or f"列{i}"
+        unique, n = name, 2
+        while unique in seen:
+            unique, n = f"{name}_{n}", n + 1
+        seen.add(unique)
+        names.append(unique)
+    return names
+
+def export_table(grid, path):
+    """按扩展名把网格写成 .csv(utf-8-sig，Excel可直接打开) 或 .parquet(首行作列名)，先写临时文件再替换"""
+    tmp_path = path + '.tmp'
+    if path.endswith('.parquet'):
+        columns = _column_names(grid[0])
+        body = grid[1:]
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            pq.write_table(pa.table({name: [row[i] for row in body] for i, name in enumerate(columns)}), tmp_path)
+        except ImportError:
+            import pandas as pd
+            pd.DataFrame(body, columns=columns).to_parquet(tmp_path, index=False)
+    else:
+        with open(tmp_path, 'w', encoding='utf-8-sig', newline='') as f:
+            csv.writer(f).writerows(grid)
+    os.replace(tmp_path, path)
+
+# --- 流式Markdown输出 ---
+TABLES_HEADER = '\n\n---\n\n### 附表\n'
+
+class MarkdownEmitter:
+    """
+    把Markdown逐块写到文本流 out，不在内存里拼整篇文档。
+    paragraphs 为True时每块套用 paragraph_breaks(句号后补空行)，留下末尾两个字符和下一块一起处理，结果与对整篇替换一次相同；
+    skip_to_heading() 之后写入的内容，第一个 '#' 之前的部分换成一个换行，始终没有 '#' 时原样写出。
+    """
+    def __init__(self, out):
+        self.out = out
+        self.paragraphs = False
+        self._carry = ''
+        self._skipped = None  # 等第一个 '#' 时暂存的内容
+
+    def set_paragraphs(self, enabled):
+        self._flush_carry()
+        self.paragraphs = enabled
+
+    def skip_to_heading(self):
+        self._flush_carry()
+        self._skipped = []
+
+    def write(self, text):
+        if not text:
+            return
+        if self.paragraphs:
+            text = paragraph_breaks(self._carry + text)
+            text, self._carry = text[:-2], text[-2:]
+        self._emit(text)
+
+    def join(self, parts, sep='\n', prefix=''):
+        """等同于 write(prefix + sep.join(parts))，parts 为空时 prefix 也不写；返回写了几块"""
+        count = 0
+        for part in parts:
+            self.write(sep if count else prefix)
+            self.write(part)
+            count += 1
+        return count
+
+    def close(self):
+        self._flush_carry()
+        if self._skipped is not None:
+            skipped, self._skipped = self._skipped, None
+            for text in skipped:
+                self.out.write(text)
+
+    def _flush_carry(self):
+        carry, self._carry = self._carry, ''
+        self._emit(carry)
+
+    def _emit(self, text):
+        if not text:
+            return
+        if self._skipped is not None:
+            hash_pos = text.find('#')
+            if hash_pos == -1:
+                self._skipped.append(text)
+                return
+            self._skipped = None
+            text = '\n' + text[hash_pos:]
+        self.out.write(text)
+
+def table_blocks(index, output_file=None):
+    """
+    正文里每个非空表格的Markdown。设置了 TABLE_EXPORT 时，够大的表格另存到 output_file 旁边(「文件名.表n.csv」)。
+    """
+    for n, table in enumerate(index.find_all('table', scoped=True), 1):
+        grid = table_grid(table)
+        if not grid:
+            continue
+        if TABLE_EXPORT and output_file and len(grid) >= TABLE_EXPORT_MIN_ROWS:
+            export_table(grid, f"{os.path.splitext(output_file)[0]}.表{n}.{TABLE_EXPORT}")
+        yield grid_to_markdown(grid)
+
+# --- 文档索引 ---
+class DocumentIndex:
+    """
+    一次遍历整棵树，按标签名、class、id 给所有元素建索引(保持文档顺序)，另外单独记下正文 div#divFullText 内的元素和所有<strong>。
+    各处理函数从索引里取节点，不再对整棵树反复 find/find_all。
+    """
+    def __init__(self, soup, scope_id='divFullText'):
+        self.by_name = {}
+        self.by_class = {}
+        self.by_id = {}
+        self.scoped_by_name = {}
+        self.scoped_by_class = {}
+        self.strongs = []
+        self.scope = None  # 正文 div，没有时为 None
+        self._order = {}
+        stack = [(child, False) for child in reversed(soup.contents) if isinstance(child, Tag)]
+        while stack:
+            tag, scoped = stack.pop()
+            self._add(tag, scoped)
+            if not scoped and self.scope is None and tag.name == 'div' and tag.get('id') == scope_id:
+                self.scope = tag
+                scoped = True
+            stack.extend((child, scoped) for child in reversed(tag.contents) if isinstance(child, Tag))
+
+    def _add(self, tag, scoped):
+        self._order[id(tag)] = len(self._order)
+        classes = tag.get('class') or ()
+        self.by_name.setdefault(tag.name, []).append(tag)
+        for cls in classes:
+            self.by_class.setdefault(cls, []).append(tag)
+        tag_id = tag.get('id')
+        if tag_id:
+            self.by_id.setdefault(tag_id, []).append(tag)
+        if scoped:
+            self.scoped_by_name.setdefault(tag.name, []).append(tag)
+            for cls in classes:
+                self.scoped_by_class.setdefault(cls, []).append(tag)
+        if tag.name == 'strong':
+            self.strongs.append(tag)
+
+    def attached(self, tag):
+        """tag 是否仍在正文 div 内(没有被 extract/unwrap/decompose 掉)"""
+        while tag is not None:
+            if tag is self.scope:
+                return True
+            tag = tag.parent
+        return False
+
+    def find_all(self, name=None, class_=None, scoped=False, where=None):
+        """
+        按标签名和/或 class 取元素，按文档顺序返回列表。class_ 为列表时命中任一即可，为带空格的字符串时须全部命中。
+        scoped 为True时只取当前仍在正文 div 内的元素；where 为额外的过滤函数。
+        """
+        by_name, by_class = (self.scoped_by_name, self.scoped_by_class) if scoped else (self.by_name, self.by_class)
+        if class_ is None:
+            tags = by_name.get(name, [])
+        elif isinstance(class_, str):
+            required = class_.split()
+            tags = [tag for tag in by_class.get(required[0], []) if all(c in tag['class'] for c in required[1:])]
+        else:
+            seen = {}
+            for cls in class_:
+                for tag in by_class.get(cls, []):
+                    seen[id(tag)] = tag
+            tags = sorted(seen.values(), key=lambda tag: self._order[id(tag)])
+        if name is not None and class_ is not None:
+            tags = [tag for tag in tags if tag.name == name]
+        if scoped:
+            tags = [tag for tag in tags if self.attached(tag)]
+        if where is not None:
+            tags = [tag for tag in tags if where(tag)]
+        return tags
+
+    def find(self, name=None, class_=None, scoped=False, where=None):
+        tags = self.find_all(name, class_, scoped, where)
+        return tags[0] if tags else None
+
+    def element(self, tag_id, name=None):
+        for tag in self.by_id.get(tag_id, []):
+            if name is None or tag.name == name:
+                return tag
+        return None
+
+    def strong(self, label, exact=False):
+        """第一个文字含 label(exact 为True时须相等)的<strong>；与 find('strong', string=...) 一样只认单一文字子节点"""
+        for tag in self.strongs:
+            text = tag.string
+            if text and (text == label if exact else label in text):
+                return tag
+        return None
+
 # --- 论文处理逻辑 ---
-def process_paper(soup):
+def process_paper(soup, out, index=None):
+    """把论文写成Markdown到文本流 out，返回输出文件路径"""
+    if index is None:
+        index = DocumentIndex(soup)
     metadata = {}
-    metadata['title'] = soup.find('h2', class_='title').text.strip()
-    safe_title = re.sub(r'[\\/*?:"<>|\n\r\t]', "", metadata['title'])
-    safe_title = re.sub(r'\s+', ' ', safe_title).strip()
+    metadata['title'] = index.find('h2', 'title').text.strip()
+    safe_title = safe_filename(metadata['title'])
     output_file = os.path.join(OUTPUT_DIR, f"{safe_title}.md")
     fields_map = {
         '作者：': 'author',
@@ -44,7 +355,8 @@ def process_paper(soup):
         '期号：': 'issue',
         '关键词：': 'keywords'
     }
-    for li in soup.select('.fields li'):
+    paper_fields = [li for fields in index.find_all(class_='fields') for li in fields.find_all('li')]
+    for li in paper_fields:
         key_strong = li.find('strong')
         if key_strong:
             key_text = key_strong.text.strip()
@@ -54,13 +366,13 @@ def process_paper(soup):
                     metadata[field_name] = [a.text.strip() for a in li.find_all('a')]
                 elif field_name == 'journal':
                     box_text = li.find('div', class_='box').decode_contents()
-                    match = re.search(r'《[^《》]+》', box_text)
+                    match = JOURNAL_RE.search(box_text)
                     if match:
                         value = match.group(0)
                         metadata[field_name] = value
                 elif field_name == 'author':
                     value = li.find('div', class_='box').text.replace(key_text, '').strip()
-                    authors = re.split(r'[；;\s]+', value)
+                    authors = AUTHOR_SPLIT_RE.split(value)
                     authors = [a for a in authors if a]
                     if len(authors) > 1:
                         metadata[field_name] = authors
@@ -70,18 +382,18 @@ def process_paper(soup):
                     value = li.find('div', class_='box').text.replace(key_text, '').strip()
                     metadata[field_name] = value
     abstract = ""
-    strong_abstract = soup.select_one('strong:contains("摘要：")')
+    strong_abstract = index.find('strong', where=lambda tag: '摘要：' in tag.get_text())
     if strong_abstract:
         abstract_p = strong_abstract.find_next('p')
         if abstract_p:
             abstract = abstract_p.text.strip()
-    full_text_div = soup.find('div', id='divFullText')
+    full_text_div = index.scope
     footnotes = {}  # 脚注 [number]
     references = {}  # 参考文献 {number}
-    footnote_spans = full_text_div.find_all('span', class_='footnote')
+    footnote_spans = index.find_all('span', 'footnote', scoped=True)
     for span in footnote_spans:
-        note_id = re.search(r'\[(\d+)\]', span.text)
-        ref_id = re.search(r'\{(\d+)\}', span.text)
+        note_id = NOTE_MARK_RE.search(span.text)
+        ref_id = REF_MARK_RE.search(span.text)
         if note_id:
             fn_id = note_id.group(1)
             fn_content = span['content'].strip()
@@ -94,38 +406,17 @@ def process_paper(soup):
             span.replace_with(f'[^{"ref_" + fn_id}]')
 
     # 补充：从 <div class="note-wrap"> 提取所有参考文献
-    note_wrap = soup.find('div', class_='note-wrap')
+    note_wrap = index.find('div', 'note-wrap')
     if note_wrap:
         for p in note_wrap.find_all('p'):
-            m = re.match(r'\{(\d+)\}', p.text.strip())
+            p_text = p.text
+            m = REF_MARK_RE.match(p_text.strip())
             if m:
                 ref_id = m.group(1)
-                ref_content = re.sub(r'^\{\d+\}', '', p.text, 1).strip()
+                lead = REF_MARK_RE.match(p_text)
+                ref_content = (p_text[lead.end():] if lead else p_text).strip()
                 if ref_id not in references:
                     references[ref_id] = ref_content
-    main_body_md = []
-    heading_patterns = [
-        {"pattern": "^[一二三四五六七八九十]、", "level": "####"},
-        {"pattern": "^（[一二三四五六七八九十]+）", "level": "#####"},
-        {"pattern": "^\\d+\\.", "level": "######"}
-    ]
-    content_elements = full_text_div.find_all('p', recursive=False)
-    for p in content_elements:
-        p_text = p.text.strip()
-        if not p_text or "【注释】" in p_text or "作者单位：" in p_text:
-            continue
-        # 替换正文中的 {n} 为 [^ref_n]
-        p_text = re.sub(r'\{(\d+)\}', lambda m: f'[^{"ref_" + m.group(1)}]', p_text)
-        is_heading = False
-        for heading in heading_patterns:
-            if re.match(heading['pattern'], p_text):
-                clean_title = re.sub(heading['pattern'], '', p_text).strip()
-                main_body_md.append(f"{heading['level']} {clean_title}\n")
-                is_heading = True
-                break
-        if not is_heading:
-            main_body_md.append(p_text + '\n')
-    main_body_str = "\n".join(main_body_md)
     # 处理 YAML 头信息
     yaml_lines = ['---']
     yaml_lines.append(f"title: \"{metadata.get('title', '')}\"")
@@ -163,38 +454,47 @@ def process_paper(soup):
         reference_lines.append('### 参考文献\n')
         for fn_id, fn_content in sorted(references.items(), key=lambda item: int(item[0])):
             reference_lines.append(f"[^{'ref_' + fn_id}]: {fn_content}\n")
-    footnote_str = "\n".join(footnote_lines)
-    reference_str = "\n".join(reference_lines)
-    # 查找所有表格
-    tables = full_text_div.find_all('table') if full_text_div else []
-    table_md = []
-    for table in tables:
-        md = html_table_to_markdown(table)
-        if md:
-            table_md.append(md)
-    if table_md:
-        tables_section = '\n\n---\n\n### 附表\n' + '\n\n'.join(table_md)
-    else:
-        tables_section = ''
-    final_md_content = f"{yaml_str}\n\n{abstract_str}\n\n---\n\n#### 前言\n\n{main_body_str}\n{footnote_str}{reference_str}{tables_section}"
-    return final_md_content, output_file
+    def body_lines():
+        for p in full_text_div.find_all('p', recursive=False):
+            p_text = p.text.strip()
+            if not p_text or "【注释】" in p_text or "作者单位：" in p_text:
+                continue
+            # 替换正文中的 {n} 为 [^ref_n]
+            p_text = ref_marks_to_footnotes(p_text)
+            heading = match_heading(p_text)
+            if heading:
+                level, clean_title = heading
+                yield f"{level} {clean_title}\n"
+            else:
+                yield p_text + '\n'
+    md = MarkdownEmitter(out)
+    md.write(f"{yaml_str}\n\n{abstract_str}\n\n---\n\n#### 前言\n\n")
+    md.join(body_lines(), '\n')
+    md.write('\n')
+    md.join(footnote_lines, '\n')
+    md.join(reference_lines, '\n')
+    md.join(table_blocks(index, output_file), '\n\n', prefix=TABLES_HEADER)
+    md.close()
+    return output_file
 
 # --- 法规处理逻辑 ---
-def process_regulation(soup):
+def process_regulation(soup, out, index=None):
+    """把法规写成Markdown到文本流 out，返回输出文件路径"""
     # 直接复用 regulation_process.py 里的逻辑
     # ...existing code...
     # 1. 提取元数据
+    if index is None:
+        index = DocumentIndex(soup)
     metadata = {}
-    title_tag = soup.find('h2', class_='title')
+    title_tag = index.find('h2', 'title')
     if title_tag:
         raw_title = ''.join([t for t in title_tag.contents if isinstance(t, NavigableString)]).strip()
         # 只去除文件名中最后一个括号及其内容（包括中文全角括号和英文半角括号），保留其他括号内容
         def remove_last_bracket_content(s):
-            import re
             # 匹配所有全角括号
-            cn = list(re.finditer(r'（([^（）]*?)）', s))
+            cn = list(CN_BRACKET_RE.finditer(s))
             # 匹配所有半角括号
-            en = list(re.finditer(r'\(([^()]*)\)', s))
+            en = list(EN_BRACKET_RE.finditer(s))
             all_brackets = cn + en
             if not all_brackets:
                 return s
@@ -210,7 +510,7 @@ def process_regulation(soup):
         raw_title = pure_title = "未知法规"
     metadata['title'] = raw_title
     def get_field_text_by_label(label_text):
-        strong_tag = soup.find('strong', string=lambda text: text and label_text in text)
+        strong_tag = index.strong(label_text)
         if strong_tag:
             parent_box = strong_tag.find_parent(class_='box')
             if parent_box:
@@ -228,7 +528,7 @@ def process_regulation(soup):
         (['国际条约'], '#规范/国际条约'),
     ]
     drafting_body_list = []
-    strong_tag = soup.find('strong', string=lambda text: text and '制定机关' in text)
+    strong_tag = index.strong('制定机关')
     if strong_tag:
         parent_box = strong_tag.find_parent(class_='box')
         if parent_box:
@@ -240,7 +540,8 @@ def process_regulation(soup):
         metadata['制定机关'] = '\n' + '\n'.join(drafting_body_list)
     else:
         metadata['制定机关'] = None
-    metadata['发文字号'] = soup.find('li', class_='row', title=True).get('title') if soup.find('li', class_='row', title=True) else get_field_text_by_label('发文字号')
+    doc_no_li = index.find('li', 'row', where=lambda tag: tag.has_attr('title'))
+    metadata['发文字号'] = doc_no_li.get('title') if doc_no_li else get_field_text_by_label('发文字号')
     metadata['公布日期'] = get_field_text_by_label('公布日期')
     metadata['施行日期'] = get_field_text_by_label('施行日期')
     metadata['时效性'] = get_field_text_by_label('时效性')
@@ -253,14 +554,14 @@ def process_regulation(soup):
     pub_date = metadata.get('公布日期', '')
     date_str = ''
     if pub_date:
-        m = re.search(r'(\d{4})[.\-年](\d{2})[.\-月](\d{2})', pub_date)
+        m = DATE_RE.search(pub_date)
         if m:
             date_str = f"{m.group(1)}-{m.group(2)}-{m.group(3)}"
     eff_level = metadata.get('tags', '')
     is_judicial_interpretation = False
     if eff_level and '司法解释' in eff_level:
         is_judicial_interpretation = True
-    m = re.search(r'(.*?[院部会委局厅署])?关于(.*)', pure_title)
+    m = ISSUER_TITLE_RE.search(pure_title)
     if m:
         short_title = f"关于{m.group(2).strip()}"
         if date_str:
@@ -281,107 +582,101 @@ def process_regulation(soup):
             yaml_lines.append(f"{key}: {value}")
     yaml_lines.append("---")
     yaml_header = "\n".join(yaml_lines)
-    full_text_div = soup.find('div', id='divFullText')
+    full_text_div = index.scope
     if full_text_div:
-        for a_tag in full_text_div.find_all('a'):
+        for a_tag in index.find_all('a', scoped=True):
             a_tag.unwrap()
-        for fb_dropdown in full_text_div.find_all(class_=['TiaoYinV2', 'c-icon']):
-            fb_dropdown.decompose()
-        content_parts = []
-        has_tiao_wrap = any(
-            hasattr(element, 'get') and element.get('class') and 'tiao-wrap' in element.get('class', [])
-            for element in full_text_div.children if hasattr(element, 'get')
-        )
-        if has_tiao_wrap:
-            for element in full_text_div.children:
-                if isinstance(element, NavigableString):
-                    continue
-                if not hasattr(element, 'name'):
-                    continue
-                class_list = element.get('class', []) if element.has_attr('class') else []
-                if 'navbian' in class_list:
-                    content_parts.append(f"## {element.get_text(strip=True)}\n")
-                elif 'navzhang' in class_list:
-                    content_parts.append(f"### {element.get_text(strip=True)}\n")
-                elif 'navjie' in class_list:
-                    content_parts.append(f"#### {element.get_text(strip=True)}\n")
-                elif 'tiao-wrap' in class_list:
-                    tiao_span = element.find('span', class_='navtiao')
-                    if tiao_span:
-                        tiao_text = re.sub(r'\s+', ' ', tiao_span.get_text(strip=True)).strip()
-                        content_parts.append(f"###### {tiao_text}")
-                    for kuan_wrap in element.find_all('div', class_='kuan-wrap'):
-                        kuan_texts = []
-                        contents = kuan_wrap.find_all(class_=['kuan-content', 'xiang-content'])
-                        for content in contents:
-                            if content.find('span', class_='navtiao'):
-                                content.find('span', class_='navtiao').decompose()
-                            cleaned_text = content.get_text().replace('　', '  ').strip()
-                            if cleaned_text:
-                                kuan_texts.append(cleaned_text)
-                        full_kuan_text = "\n".join(kuan_texts)
-                        content_parts.append(full_kuan_text)
-                    content_parts.append('')
-                elif element.name == 'div' and element.get('align') == 'center':
-                    content_parts.append(element.get_text(separator='\n', strip=True))
-                    content_parts.append('')
-                elif element.name == 'p' and element.get_text(strip=True):
-                    content_parts.append(element.get_text(strip=True))
-                    content_parts.append('')
-        else:
-            # 没有 tiao-wrap，直接查找所有 navtiao span，按条标题和正文分组
-            navtiao_spans = full_text_div.find_all('span', class_='navtiao')
-            for navtiao in navtiao_spans:
-                tiao_text = re.sub(r'\s+', ' ', navtiao.get_text(strip=True)).strip()
-                content_parts.append(f"###### {tiao_text}")
-                # 收集该 span 后面紧跟的所有兄弟节点，直到下一个 navtiao 或结束
-                tiao_content = []
-                for sib in navtiao.next_siblings:
-                    if getattr(sib, 'name', None) == 'span' and 'navtiao' in sib.get('class', []):
-                        break
-                    if isinstance(sib, NavigableString):
-                        text = sib.strip()
-                        if text:
-                            tiao_content.append(text)
-                    elif hasattr(sib, 'get_text'):
-                        text = sib.get_text(strip=True)
-                        if text:
-                            tiao_content.append(text)
-                if tiao_content:
-                    content_parts.append("\n".join(tiao_content))
-                content_parts.append('')
-        main_content = "\n".join(content_parts)
-        # 查找所有表格
-        tables = full_text_div.find_all('table')
-        table_md = []
-        for table in tables:
-            md = html_table_to_markdown(table)
-            if md:
-                table_md.append(md)
-        if table_md:
-            tables_section = '\n\n---\n\n### 附表\n' + '\n\n'.join(table_md)
-        else:
-            tables_section = ''
-        main_content = main_content + tables_section
-    else:
-        main_content = "未能找到正文内容。"
-    main_content = re.sub(r'。\n(?=.)', '。\n\n', main_content)
-    final_markdown = f"{yaml_header}\n\n{main_content}"
-    safe_title = re.sub(r'[\\/*?:"<>|\n\r\t]', "", final_title)
-    safe_title = re.sub(r'\s+', ' ', safe_title).strip()
+        for fb_dropdown in index.find_all(class_=['TiaoYinV2', 'c-icon'], scoped=True):
+            # 嵌套在前一个里的已随之删除
+            if index.attached(fb_dropdown):
+                fb_dropdown.decompose()
+        def regulation_parts():
+            has_tiao_wrap = any(
+                hasattr(element, 'get') and element.get('class') and 'tiao-wrap' in element.get('class', [])
+                for element in full_text_div.children if hasattr(element, 'get')
+            )
+            if has_tiao_wrap:
+                for element in full_text_div.children:
+                    if isinstance(element, NavigableString):
+                        continue
+                    if not hasattr(element, 'name'):
+                        continue
+                    class_list = element.get('class', []) if element.has_attr('class') else []
+                    if 'navbian' in class_list:
+                        yield f"## {element.get_text(strip=True)}\n"
+                    elif 'navzhang' in class_list:
+                        yield f"### {element.get_text(strip=True)}\n"
+                    elif 'navjie' in class_list:
+                        yield f"#### {element.get_text(strip=True)}\n"
+                    elif 'tiao-wrap' in class_list:
+                        tiao_span = element.find('span', class_='navtiao')
+                        if tiao_span:
+                            tiao_text = collapse_whitespace(tiao_span.get_text(strip=True))
+                            yield f"###### {tiao_text}"
+                        for kuan_wrap in element.find_all('div', class_='kuan-wrap'):
+                            kuan_texts = []
+                            contents = kuan_wrap.find_all(class_=['kuan-content', 'xiang-content'])
+                            for content in contents:
+                                if content.find('span', class_='navtiao'):
+                                    content.find('span', class_='navtiao').decompose()
+                                cleaned_text = content.get_text().replace('　', '  ').strip()
+                                if cleaned_text:
+                                    kuan_texts.append(cleaned_text)
+                            full_kuan_text = "\n".join(kuan_texts)
+                            yield full_kuan_text
+                        yield ''
+                    elif element.name == 'div' and element.get('align') == 'center':
+                        yield element.get_text(separator='\n', strip=True)
+                        yield ''
+                    elif element.name == 'p' and element.get_text(strip=True):
+                        yield element.get_text(strip=True)
+                        yield ''
+            else:
+                # 没有 tiao-wrap，直接查找所有 navtiao span，按条标题和正文分组
+                navtiao_spans = index.find_all('span', 'navtiao', scoped=True)
+                for navtiao in navtiao_spans:
+                    tiao_text = collapse_whitespace(navtiao.get_text(strip=True))
+                    yield f"###### {tiao_text}"
+                    # 收集该 span 后面紧跟的所有兄弟节点，直到下一个 navtiao 或结束
+                    tiao_content = []
+                    for sib in navtiao.next_siblings:
+                        if getattr(sib, 'name', None) == 'span' and 'navtiao' in sib.get('class', []):
+                            break
+                        if isinstance(sib, NavigableString):
+                            text = sib.strip()
+                            if text:
+                                tiao_content.append(text)
+                        elif hasattr(sib, 'get_text'):
+                            text = sib.get_text(strip=True)
+                            if text:
+                                tiao_content.append(text)
+                    if tiao_content:
+                        yield "\n".join(tiao_content)
+                    yield ''
+    safe_title = safe_filename(final_title)
     output_file = os.path.join(OUTPUT_DIR, f"{safe_title}.md")
-    split1 = final_markdown.find('---', final_markdown.find('---')+3)
-    if split1 != -1:
-        hash_pos = final_markdown.find('#', split1)
-        if hash_pos != -1:
-            final_markdown = final_markdown[:split1+3] + '\n' + final_markdown[hash_pos:]
-    return final_markdown, output_file
+    md = MarkdownEmitter(out)
+    md.write(yaml_header)
+    # YAML头和第一个标题之间的内容换成一个空行
+    md.skip_to_heading()
+    md.write('\n\n')
+    md.set_paragraphs(True)
+    if full_text_div:
+        md.join(regulation_parts(), '\n')
+        md.join(table_blocks(index, output_file), '\n\n', prefix=TABLES_HEADER)
+    else:
+        md.write("未能找到正文内容。")
+    md.close()
+    return output_file
 
 # --- 案例处理逻辑 ---
-def process_case(soup):
+def process_case(soup, out, index=None):
+    """把案例写成Markdown到文本流 out，返回输出文件路径"""
+    if index is None:
+        index = DocumentIndex(soup)
     metadata = {}
-    def get_field_text(soup_obj, label_text):
-        strong_tag = soup_obj.find('strong', string=lambda text: text and label_text in text)
+    def get_field_text(label_text):
+        strong_tag = index.strong(label_text)
         if strong_tag:
             parent_box = strong_tag.find_parent(class_='box')
             if parent_box:
@@ -391,19 +686,19 @@ def process_case(soup):
                 else:
                     return [strong_tag.parent.get_text(strip=True).replace(label_text, '').replace('：', '').strip()]
         return []
-    case_no_li = soup.find('li', title=lambda x: x and '号' in x)
+    case_no_li = index.find('li', where=lambda tag: '号' in (tag.get('title') or ''))
     if case_no_li:
         metadata['案号'] = case_no_li.get('title', '未知案号').strip()
     else:
-        case_no_span = soup.find('span', class_='case-flag self')
+        case_no_span = index.find('span', 'case-flag self')
         metadata['案号'] = case_no_span.get_text(strip=True) if case_no_span else '未知案号'
-    metadata['审理法院'] = get_field_text(soup, '审理法院')
-    metadata['审结日期'] = get_field_text(soup, '审结日期')
-    metadata['文书类型'] = get_field_text(soup, '文书类型')
-    metadata['审理程序'] = get_field_text(soup, '审理程序')
-    metadata['keywords'] = get_field_text(soup, '权责关键词')
-    metadata['案件要素'] = get_field_text(soup, '案件要素')
-    anyou_links = soup.find('strong', string='案由：').parent.find_all('a', class_=None)
+    metadata['审理法院'] = get_field_text('审理法院')
+    metadata['审结日期'] = get_field_text('审结日期')
+    metadata['文书类型'] = get_field_text('文书类型')
+    metadata['审理程序'] = get_field_text('审理程序')
+    metadata['keywords'] = get_field_text('权责关键词')
+    metadata['案件要素'] = get_field_text('案件要素')
+    anyou_links = index.strong('案由：', exact=True).parent.find_all('a', class_=None)
     anyou_parts = [a.get_text(strip=True) for a in anyou_links]
     if anyou_parts:
         metadata['案由_tag'] = f"民事案由/{'/'.join(anyou_parts[1:])}"
@@ -423,9 +718,9 @@ def process_case(soup):
             yaml_lines.append(f"{key}: {values}")
     yaml_lines.append("---")
     yaml_header = "\n".join(yaml_lines)
-    full_text_div = soup.find('div', id='divFullText')
+    full_text_div = index.scope
     if full_text_div:
-        a_tags_to_merge = full_text_div.find_all('a')
+        a_tags_to_merge = index.find_all('a', scoped=True)
         for a_tag in a_tags_to_merge:
             prev_sibling = a_tag.previous_sibling
             next_sibling = a_tag.next_sibling
@@ -439,7 +734,7 @@ def process_case(soup):
                 a_tag.extract()
             else:
                 a_tag.replace_with(a_text)
-        spans_to_merge = full_text_div.find_all('span', class_=lambda c: c and 'case-flag' in c)
+        spans_to_merge = index.find_all('span', scoped=True, where=lambda tag: any('case-flag' in c for c in tag.get('class') or ()))
         for span in spans_to_merge:
             prev_sibling = span.previous_sibling
             next_sibling = span.next_sibling
@@ -453,80 +748,394 @@ def process_case(soup):
                 span.extract()
             else:
                 span.replace_with(span_text)
-        for span_tag in full_text_div.find_all('span', class_='anchor-case'):
+        for span_tag in index.find_all('span', 'anchor-case', scoped=True):
             title_text = span_tag.get_text(strip=True)
             if title_text:
                 span_tag.insert_before(f"\n\n##### {title_text}\n")
             span_tag.decompose()
-        main_content = full_text_div.get_text(separator='\n\n', strip=True)
-        main_content = main_content.replace('[', r'\[').replace(']', r'\]')
-        # 查找所有表格
-        tables = full_text_div.find_all('table')
-        table_md = []
-        for table in tables:
-            md = html_table_to_markdown(table)
-            if md:
-                table_md.append(md)
-        if table_md:
-            tables_section = '\n\n---\n\n### 附表\n' + '\n\n'.join(table_md)
-        else:
-            tables_section = ''
-        main_content = main_content + tables_section
-    else:
-        main_content = "未能找到正文内容。"
-    final_markdown = f"{yaml_header}\n\n{main_content}"
-    safe_case_title = re.sub(r'[\\/*?:"<>|\n\r\t]', "", metadata.get('案号', '未命名案例'))
-    safe_case_title = re.sub(r'\s+', ' ', safe_case_title).strip()
+    safe_case_title = safe_filename(metadata.get('案号', '未命名案例'))
     output_file = os.path.join(OUTPUT_DIR, f"{safe_case_title}.md")
-    return final_markdown, output_file
+    md = MarkdownEmitter(out)
+    md.write(f"{yaml_header}\n\n")
+    if full_text_div:
+        # 等同于 get_text(separator='\n\n', strip=True) 后整体转义方括号，但逐段写出
+        md.join(map(escape_brackets, full_text_div.stripped_strings), '\n\n')
+        md.join(table_blocks(index, output_file), '\n\n', prefix=TABLES_HEADER)
+    else:
+        md.write("未能找到正文内容。")
+    md.close()
+    return output_file
 
 # --- 类型自动检测与主流程 ---
-def detect_type_and_process(html_filepath):
-    with open(html_filepath, 'r', encoding='utf-8') as f:
-        html_content = f.read()
-    soup = BeautifulSoup(html_content, 'lxml')
+PROCESSORS = {
+    'regulation': process_regulation,
+    'case': process_case,
+    'paper': process_paper,
+}
+TYPE_NAMES = {'regulation': '法规', 'case': '案例', 'paper': '论文'}
+
+# 常见引证码格式：CLI.1.153700、CLI.11.518085、CLI.WR.3553、CLI.C.375295等
+CITATION_RE = re.compile(r'(CLI\.[A-Z0-9]+\.[A-Z0-9]+|CLI\.[A-Z]+\.[A-Z0-9]+|CLI\.[A-Z]+\.[A-Z0-9]+|CLI\.[A-Z]+)')
+# 按区域解析时保留的 class；另外保留 div#divFullText 和带 title 的 li(发文字号/案号)
+PARSE_CLASSES = {'title', 'fields', 'box', 'note-wrap', 'case-flag'}
+
+# 处理函数按这些<strong>标签取元数据；原文里有、按区域解析后却找不到时退回解析整页
+HANDLER_LABELS = {
+    'paper': ['作者：', '期刊名称：', '期刊年份：', '期号：', '关键词：', '摘要：'],
+    'regulation': ['制定机关', '发文字号', '公布日期', '施行日期', '时效性', '效力位阶'],
+    'case': ['审理法院', '审结日期', '文书类型', '审理程序', '权责关键词', '案件要素', '案由：'],
+}
+
+def _in_content_region(name, attrs):
+    """按标签名和属性判断：命中的元素连同子树保留，导航栏、页脚、脚本等整段不建节点"""
+    attrs = attrs or {}
+    if attrs.get('id') == 'divFullText':
+        return True
+    if name == 'li' and attrs.get('title'):
+        return True
+    classes = attrs.get('class') or ()
+    if isinstance(classes, str):
+        classes = classes.split()
+    return any(c in PARSE_CLASSES for c in classes)
+
+if ElementFilter is not None:
+    class ContentStrainer(ElementFilter):
+        """bs4 4.13 起 SoupStrainer(函数) 只把标签名传给函数，改为在建节点前的钩子里判断"""
+        def allow_tag_creation(self, nsprefix, name, attrs):
+            return _in_content_region(name, attrs)
+
+        def allow_string_creation(self, string):
+            # 只对保留区域之外的文字调用
+            return False
+
+    CONTENT_STRAINER = ContentStrainer()
+else:
+    # 旧版 bs4 在建节点前以 (标签名, 属性) 调用函数
+    CONTENT_STRAINER = SoupStrainer(_in_content_region)
+
+def _top_region(tag):
+    """tag 所在的、挂在文档根下的那个保留区域"""
+    while tag.parent is not None and tag.parent.parent is not None:
+        tag = tag.parent
+    return tag
+
+def strained_complete(doc_type, html_content, index):
+    """
+    按区域解析的结果是否包含处理函数要读的全部内容：标题，原文里出现过的各个标签，
+    以及论文摘要后面的段落(须和「摘要：」在同一保留区域内，否则 find_next 会取到别处的段落)。
+    """
+    if not index.find('h2', 'title'):
+        return False
+    for label in HANDLER_LABELS[doc_type]:
+        if label in html_content and not index.find('strong', where=lambda tag: label in tag.get_text()):
+            if re.search(r'<strong[^>]*>[^<]*' + re.escape(label), html_content):
+                return False
+    if doc_type == 'paper':
+        strong_abstract = index.find('strong', where=lambda tag: '摘要：' in tag.get_text())
+        if strong_abstract:
+            abstract_p = strong_abstract.find_next('p')
+            if abstract_p is None or _top_region(abstract_p) is not _top_region(strong_abstract):
+                return False
+    return True
+
+def classify_citation(citation_code):
+    """按引证码前缀返回类型，不认识的返回 None"""
+    # 法律法规（中央/地方法规/中外条约/外国/港澳台/年鉴/英文译本等）
+    if re.match(r'CLI\.(1|2|3|4|11|T|FL|HK|MAC|TW|WR|N|ALE)\.', citation_code) or citation_code.startswith('CLI.WR.'):
+        return 'regulation'
+    # 案例/判决/仲裁/案例报道/检察文书/行政执法/合同范本/法律文书
+    elif re.match(r'CLI\.(C|CR|AA|P|LD|ALE|CS)\.', citation_code):
+        return 'case'
+    # 期刊/文献/专家解读/律所实务/法学期刊/法学文献
+    elif re.match(r'CLI\.(A|J|L|A)\.', citation_code):
+        return 'paper'
+    return None
+
+def find_citation(html_content, head_chars=None):
+    """
+    返回HTML里第一个引证码，没有时返回 None。给了 head_chars 时先只搜开头，
+    命中且没有碰到截断处就不再搜全文(全文搜索的第一个匹配必然也是它)。
+    """
+    if head_chars and len(html_content) > head_chars:
+        code_match = CITATION_RE.search(html_content, 0, head_chars)
+        if code_match and code_match.end() < head_chars:
+            return code_match.group(0)
+    code_match = CITATION_RE.search(html_content)
+    return code_match.group(0) if code_match else None
+
+def detect_type(html_content, index, citation_code=None):
+    """
+    返回 (类型, 引证码)，类型为 'regulation' / 'case' / 'paper'，无法识别时为 None。
+    已经找过引证码时可通过 citation_code 传入。
+    """
     # 优先通过法宝引证码判断类型
-    citation_code = None
-    # 常见引证码格式：CLI.1.153700、CLI.11.518085、CLI.WR.3553、CLI.C.375295等
-    code_match = re.search(r'(CLI\.[A-Z0-9]+\.[A-Z0-9]+|CLI\.[A-Z]+\.[A-Z0-9]+|CLI\.[A-Z]+\.[A-Z0-9]+|CLI\.[A-Z]+)', html_content)
-    if code_match:
-        citation_code = code_match.group(0)
-        # 法律法规（中央/地方法规/中外条约/外国/港澳台/年鉴/英文译本等）
-        if re.match(r'CLI\.(1|2|3|4|11|T|FL|HK|MAC|TW|WR|N|ALE)\.', citation_code) or citation_code.startswith('CLI.WR.'):
-            print(f'检测到类型：法规（引证码 {citation_code}）')
-            return process_regulation(soup)
-        # 案例/判决/仲裁/案例报道/检察文书/行政执法/合同范本/法律文书
-        elif re.match(r'CLI\.(C|CR|AA|P|LD|ALE|CS)\.', citation_code):
-            print(f'检测到类型：案例（引证码 {citation_code}）')
-            return process_case(soup)
-        # 期刊/文献/专家解读/律所实务/法学期刊/法学文献
-        elif re.match(r'CLI\.(A|J|L|A)\.', citation_code):
-            print(f'检测到类型：论文/文献（引证码 {citation_code}）')
-            return process_paper(soup)
+    if citation_code is None:
+        citation_code = find_citation(html_content)
+    if citation_code:
+        doc_type = classify_citation(citation_code)
+        if doc_type:
+            return doc_type, citation_code
     # 如果引证码未命中，回退HTML结构判断
     # 检测论文
-    if soup.find('h2', class_='title') and soup.find('div', class_='fields'):
-        print('检测到类型：论文')
-        return process_paper(soup)
+    if index.find('h2', 'title') and index.find('div', 'fields'):
+        return 'paper', None
     # 检测法规
-    if soup.find('h2', class_='title') and soup.find('div', id='divFullText') and soup.find('strong', string=lambda t: t and '制定机关' in t):
-        print('检测到类型：法规')
-        return process_regulation(soup)
+    if index.find('h2', 'title') and index.scope and index.strong('制定机关'):
+        return 'regulation', None
     # 检测案例
-    if soup.find('h2', class_='title') and soup.find('div', id='divFullText') and soup.find('strong', string=lambda t: t and '审理法院' in t):
-        print('检测到类型：案例')
-        return process_case(soup)
-    print('未能识别HTML类型，未处理。')
+    if index.find('h2', 'title') and index.scope and index.strong('审理法院'):
+        return 'case', None
     return None, None
 
+def load_document(html_filepath, strained=STRAINED_PARSE):
+    """
+    读入HTML，先用引证码定类型，再只按处理函数用到的区域解析。
+    引证码认不出类型、或按区域解析漏掉了处理函数要读的内容时，退回解析整页再按结构判断。
+    返回 (类型, 引证码, soup, index)。
+    """
+    with open(html_filepath, 'r', encoding='utf-8') as f:
+        html_content = f.read()
+    citation_code = find_citation(html_content, DETECT_HEAD_CHARS)
+    doc_type = classify_citation(citation_code) if citation_code else None
+    if strained and doc_type:
+        soup = BeautifulSoup(html_content, 'lxml', parse_only=CONTENT_STRAINER)
+        index = DocumentIndex(soup)
+        if strained_complete(doc_type, html_content, index):
+            return doc_type, citation_code, soup, index
+    soup = BeautifulSoup(html_content, 'lxml')
+    index = DocumentIndex(soup)
+    doc_type, citation_code = detect_type(html_content, index, citation_code or '')
+    return doc_type, citation_code, soup, index
+
+def detect_type_and_process(html_filepath, out=None):
+    """out 为文本流时把Markdown写进去，返回 (None, 输出路径)；否则返回 (Markdown文本, 输出路径)"""
+    doc_type, citation_code, soup, index = load_document(html_filepath)
+    if doc_type is None:
+        print('未能识别HTML类型，未处理。')
+        return None, None
+    if citation_code:
+        print(f'检测到类型：{TYPE_NAMES[doc_type]}（引证码 {citation_code}）')
+    else:
+        print(f'检测到类型：{TYPE_NAMES[doc_type]}')
+    if out is not None:
+        return None, PROCESSORS[doc_type](soup, out, index)
+    buffer = io.StringIO()
+    output_file = PROCESSORS[doc_type](soup, buffer, index)
+    return buffer.getvalue(), output_file
+
+def write_streamed(directory, render):
+    """
+    render(f) 把Markdown边生成边写进 directory 下的临时文件，并返回最终路径；写完后原子替换，中断时不会留下半个Markdown文件。
+    render 返回 None 时丢弃临时文件。返回最终路径或 None。
+    """
+    os.makedirs(directory or '.', exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory or '.', prefix='.tmp_', suffix='.md')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            path = render(f)
+        if path is None:
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+        return path
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+# --- 批量模式 ---
+def iter_input_files(source):
+    """source 为目录时递归取其中的 .html/.htm，否则按通配符匹配"""
+    if os.path.isdir(source):
+        for root, _, files in os.walk(source):
+            for name in sorted(files):
+                if name.lower().endswith(('.html', '.htm')):
+                    yield os.path.join(root, name)
+    else:
+        yield from sorted(glob.glob(source, recursive=True))
+
+def _init_worker(output_dir):
+    # 各处理函数按模块级 OUTPUT_DIR 生成输出路径，子进程里改成本次批量的输出目录
+    global OUTPUT_DIR
+    OUTPUT_DIR = output_dir
+
+def convert_file(html_filepath):
+    """在子进程中转换一个文件并原子写出，返回结果字典，不抛异常"""
+    start = time.perf_counter()
+    result = {'input': html_filepath, 'type': None, 'output': None, 'error': None}
+    try:
+        doc_type, _, soup, index = load_document(html_filepath)
+        result['type'] = doc_type
+        if doc_type is None:
+            result['error'] = '未能识别HTML类型'
+        else:
+            result['output'] = write_streamed(OUTPUT_DIR, lambda f: PROCESSORS[doc_type](soup, f, index))
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+# --- 增量模式 ---
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+class ConversionManifest:
+    """
+    增量转换清单(JSON lines，存于输出目录)：输入路径 -> 大小/修改时间、内容哈希、输出路径、转换器版本。
+    每转换成功一个文件追加一行，同一输入以最后一行为准；结束时压缩重写。
+    """
+    def __init__(self, output_dir, filename='.pkulaw_manifest.jsonl'):
+        self.path = os.path.join(output_dir, filename)
+        self.entries = {}
+        self._f = None
+
+    def load(self):
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.entries[entry['input']] = entry
+                    except (ValueError, KeyError, TypeError):
+                        continue  # 写入时被中断的残行
+        return self
+
+    def is_current(self, path):
+        """
+        输入没变、转换器版本相同且输出还在时返回 (True, None)；
+        否则返回 (False, 内容哈希)。大小和修改时间都没变时不读文件。
+        """
+        entry = self.entries.get(path)
+        if not entry or entry.get('version') != CONVERTER_VERSION or not os.path.exists(entry.get('output') or ''):
+            return False, None
+        st = os.stat(path)
+        if st.st_size == entry.get('size') and st.st_mtime_ns == entry.get('mtime'):
+            return True, None
+        digest = file_digest(path)
+        if digest != entry.get('sha256'):
+            return False, digest
+        # 只是被 touch 过，内容没变：更新时间戳，下次不必再算哈希
+        self.record(dict(entry, size=st.st_size, mtime=st.st_mtime_ns))
+        return True, None
+
+    def record(self, entry):
+        self.entries[entry['input']] = entry
+        if self._f is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._f = open(self.path, 'a', encoding='utf-8')
+        self._f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._f.flush()
+
+    def orphans(self):
+        """源文件已被删除的条目"""
+        return [entry for path, entry in self.entries.items() if not os.path.exists(path)]
+
+    def live_outputs(self):
+        """源文件还在的条目的输出路径(normcase 后)"""
+        return {os.path.normcase(entry['output']) for path, entry in self.entries.items() if entry.get('output') and os.path.exists(path)}
+
+    def forget(self, path):
+        self.entries.pop(path, None)
+
+    def compact(self):
+        """去掉重复行后原子重写"""
+        if self._f:
+            self._f.close()
+            self._f = None
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+
+def batch_convert(source, output_dir=OUTPUT_DIR, workers=BATCH_WORKERS, chunksize=16, incremental=INCREMENTAL, prune=False):
+    """
+    批量转换 source(目录或通配符)下的所有HTML，用进程池并行解析，结束时按类型汇总成功/失败数和耗时。
+    incremental 为True时跳过清单中未变化的文件(不解析)，并报告源文件已删除的输出；prune 为True时顺带删除这些输出。
+    返回本次转换的每个文件的结果列表。
+    """
+    files = [os.path.abspath(path) for path in iter_input_files(source)]
+    manifest = ConversionManifest(output_dir).load() if incremental else None
+    digests = {}
+    if manifest:
+        todo = []
+        for path in files:
+            current, digest = manifest.is_current(path)
+            if not current:
+                todo.append(path)
+                digests[path] = digest
+        print(f"共 {len(files)} 个HTML文件，未变化 {len(files) - len(todo)} 个，需要转换 {len(todo)} 个...")
+    else:
+        todo = files
+        print(f"共 {len(files)} 个HTML文件，开始转换...")
+    start = time.perf_counter()
+    results = []
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(output_dir,)) as executor:
+            for result in executor.map(convert_file, todo, chunksize=chunksize):
+                results.append(result)
+                if result['error']:
+                    print(f"失败: {result['input']} - {result['error']}")
+                elif manifest:
+                    path = result['input']
+                    st = os.stat(path)
+                    manifest.record({
+                        'input': path, 'size': st.st_size, 'mtime': st.st_mtime_ns,
+                        'sha256': digests.get(path) or file_digest(path),
+                        'output': os.path.abspath(result['output']), 'version': CONVERTER_VERSION, 'type': result['type'],
+                    })
+    print(format_batch_report(results, time.perf_counter() - start))
+    if manifest:
+        orphans = manifest.orphans()
+        if orphans:
+            print(f"{len(orphans)} 个输出的源文件已删除{'，已一并删除' if prune else ''}：")
+            # 输出可能同时属于另一个还在的输入(标题相同，或文件改名后又改回)，这种输出不能删
+            live = manifest.live_outputs()
+            for entry in orphans:
+                shared = os.path.normcase(entry['output']) in live
+                print(f"  {entry['output']} <- {entry['input']}{'(仍是其他输入的输出，保留)' if shared else ''}")
+                if prune:
+                    if not shared and os.path.exists(entry['output']):
+                        os.remove(entry['output'])
+                    manifest.forget(entry['input'])
+        manifest.compact()
+    return results
+
+def format_batch_report(results, elapsed):
+    stats = {}
+    outputs = {}
+    for result in results:
+        name = TYPE_NAMES.get(result['type'], '未识别')
+        stat = stats.setdefault(name, {'ok': 0, 'fail': 0, 'seconds': 0.0})
+        stat['fail' if result['error'] else 'ok'] += 1
+        stat['seconds'] += result['seconds']
+        if result['output']:
+            outputs.setdefault(result['output'], []).append(result['input'])
+    lines = [f"批量转换完成，用时 {elapsed:.1f}s："]
+    for name, stat in stats.items():
+        count = stat['ok'] + stat['fail']
+        lines.append(f"  {name}: 成功 {stat['ok']}，失败 {stat['fail']}，累计 {stat['seconds']:.1f}s，平均 {stat['seconds'] / count * 1000:.0f}ms")
+    # 标题相同的文件会写到同一个输出，后写的覆盖先写的
+    collisions = {path: inputs for path, inputs in outputs.items() if len(inputs) > 1}
+    if collisions:
+        lines.append(f"  注意：{len(collisions)} 个输出文件对应多个输入，只保留了最后一个：")
+        for path, inputs in list(collisions.items())[:20]:
+            lines.append(f"    {path} <- {', '.join(inputs)}")
+    return "\n".join(lines)
+
 if __name__ == "__main__":
-    if not os.path.exists(INPUT_HTML_FILE):
+    if INPUT_DIR:
+        batch_convert(INPUT_DIR, OUTPUT_DIR)
+    elif not os.path.exists(INPUT_HTML_FILE):
         print(f"错误：输入文件 '{INPUT_HTML_FILE}' 不存在。请确保该文件和脚本在同一目录下。")
     else:
-        markdown_output, output_filename = detect_type_and_process(INPUT_HTML_FILE)
-        if markdown_output and output_filename:
-            with open(output_filename, 'w', encoding='utf-8') as f:
-                f.write(markdown_output)
+        output_filename = write_streamed(OUTPUT_DIR, lambda f: detect_type_and_process(INPUT_HTML_FILE, f)[1])
+        if output_filename:
             print(f"🎉 成功！已将内容解析并保存为: {output_filename}")
         else:
             print("未生成任何输出。")
@@ -0,0 +1,356 @@
+"""
+site: icourse163.org (离线)
+	description: 本地替身服务器，回放学期/签名/视频链接/m3u8/分片接口，可注入延迟、带宽限制和错误，供 test.py 离线测试和基准测试使用。
+"""
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+# 回放录制的目录结构：
+#   term.json                   getLastLearnedMocTermDto 的原始响应
+#   vod/<videoId>.json          视频链接接口的原始响应(videoUrl 会被改写到本地)
+#   hls/<videoId>/index.m3u8    媒体播放列表，分片和密钥写成相对文件名
+#   hls/<videoId>/<分片文件>
+
+TS_PACKET = 188
+
+def fake_ts(seed, size):
+	"""
+	生成约 size 字节的假 TS 数据：每 188 字节一个以 0x47 开头的包，内容由 seed 决定。
+	长度向下取整到整包(至少一包)，否则过不了下载端的 TS 长度校验。
+	"""
+	payload = bytes([seed % 256]) * (TS_PACKET - 4)
+	packet = b'\x47\x01\x00\x10' + payload
+	return packet * max(1, size // TS_PACKET)
+
+class SyntheticCourse:
+	"""
+	按参数生成的虚拟课程：chapters 章，每章若干视频，每个视频 segments 个分片，每片 segment_size 字节。
+	不需要任何录制文件，适合比较并发数、块大小、引擎等配置。
+	"""
+	def __init__(self, videos=12, chapters=3, segments=20, segment_size=512 * 1024, segment_seconds=10.0):
+		self.videos = videos
+		self.chapters = chapters
+		self.segments = segments
+		self.segment_size = segment_size
+		self.segment_seconds = segment_seconds
+
+	def term_json(self):
+		chapters = []
+		per_chapter = max(1, -(-self.videos // self.chapters))
+		for c in range(self.chapters):
+			ids = range(c * per_chapter, min(self.videos, (c + 1) * per_chapter))
+			lessons = [{"units": [{"contentType": 1, "contentId": 1000 + i, "id": 5000 + i, "name": f"视频{i + 1}"}]} for i in ids]
+			if lessons:
+				chapters.append({"name": f"第{c + 1}章", "lessons": lessons})
+		return {"code": 0, "result": {"mocTermDto": {"courseName": "离线回放课程", "chapters": chapters}}}
+
+	def video_ids(self):
+		return [1000 + i for i in range(self.videos)]
+
+	def vod_json(self, video_id):
+		return {"code": 0, "result": {"videos": [{"format": "hls", "quality": 1, "videoUrl": ""}]}}
+
+	def playlist(self, video_id):
+		lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{int(self.segment_seconds)}", "#EXT-X-MEDIA-SEQUENCE:0"]
+		for idx in range(self.segments):
+			lines.append(f"#EXTINF:{self.segment_seconds:.1f},")
+			lines.append(f"{idx}.ts")
+		lines.append("#EXT-X-ENDLIST")
+		return "\n".join(lines) + "\n"
+
+	def segment(self, video_id, name):
+		idx = int(name.split('.', 1)[0])
+		if not 0 <= idx < self.segments:
+			return None
+		return fake_ts(video_id + idx, self.segment_size)
+
+class RecordedCourse:
+	"""从录制目录回放真实响应(目录结构见文件开头)"""
+	def __init__(self, path):
+		self.path = path
+
+	def _read(self, *parts):
+		full = os.path.join(self.path, *parts)
+		if not os.path.isfile(full):
+			return None
+		with open(full, 'rb') as f:
+			return f.read()
+
+	def term_json(self):
+		return json.loads(self._read("term.json"))
+
+	def video_ids(self):
+		return [int(name[:-5]) for name in os.listdir(os.path.join(self.path, "vod")) if name.endswith(".json")]
+
+	def vod_json(self, video_id):
+		raw = self._read("vod", f"{video_id}.json")
+		return json.loads(raw) if raw else None
+
+	def playlist(self, video_id):
+		raw = self._read("hls", str(video_id), "index.m3u8")
+		return raw.decode('utf-8') if raw else None
+
+	def segment(self, video_id, name):
+		return self._read("hls", str(video_id), os.path.basename(name))
+
+def record_course(out_dir, term_id=None, limit=None):
+	"""
+	用 test.py 的真实会话录制一门课：学期响应、视频链接响应、选中清晰度的媒体播放列表、全部分片和密钥。
+	term_id 默认为 test.tid，limit 限制录制的视频数。需要有效 cookie。
+	"""
+	import test
+	term_id = term_id or test.tid
+	term_json = test.term_avail(test.get_csrfkey(), term_id)
+	units = test.get_video_units(test.get_chapters(term_json), term_id=term_id)[:limit]
+	os.makedirs(os.path.join(out_dir, "vod"), exist_ok=True)
+	with open(os.path.join(out_dir, "term.json"), 'w', encoding='utf-8') as f:
+		json.dump(term_json, f, ensure_ascii=False)
+	for unit in units:
+		signature = test.get_signature(unit.bizid, test.get_csrfkey())
+		params = {"videoId": unit.content_id, "signature": signature, "clientType": 1}
+		resp_json = test.call_rpc('video_link', lambda: test.http.get(test.VIDEO_API, params=params))
+		if not resp_json:
+			print(f"{unit.name} 视频链接获取失败，跳过")
+			continue
+		with open(os.path.join(out_dir, "vod", f"{unit.content_id}.json"), 'w', encoding='utf-8') as f:
+			json.dump(resp_json, f, ensure_ascii=False)
+		media_url, text = test.load_playlist(test.select_video(resp_json['result']['videos']))
+		video_dir = os.path.join(out_dir, "hls", str(unit.content_id))
+		os.makedirs(video_dir, exist_ok=True)
+		saved = {}
+		def local_name(uri):
+			url = test.urljoin(media_url, uri)
+			if url not in saved:
+				saved[url] = f"{len(saved)}_{os.path.basename(urlsplit(url).path)}"
+				r = test.http.get(url, timeout=60)
+				r.raise_for_status()
+				with open(os.path.join(video_dir, saved[url]), 'wb') as f:
+					f.write(r.content)
+			return saved[url]
+		lines = []
+		for line in text.splitlines():
+			stripped = line.strip()
+			if stripped.startswith('#EXT-X-KEY:') and 'URI="' in stripped:
+				line = re.sub(r'URI="([^"]*)"', lambda m: f'URI="{local_name(m.group(1))}"', stripped)
+			elif stripped and not stripped.startswith('#'):
+				line = local_name(stripped)
+			lines.append(line)
+		with open(os.path.join(video_dir, "index.m3u8"), 'w', encoding='utf-8') as f:
+			f.write("\n".join(lines) + "\n")
+		print(f"{unit.name} 已录制 {len(saved)} 个文件")
+
+class ReplayHandler(BaseHTTPRequestHandler):
+	# 支持长连接，和线上一样能测出连接复用的效果
+	protocol_version = "HTTP/1.1"
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_POST(self):
+		length = int(self.headers.get('Content-Length') or 0)
+		form = parse_qs(self.rfile.read(length).decode('utf-8')) if length else {}
+		path = urlsplit(self.path).path
+		if path.endswith("courseBean.getLastLearnedMocTermDto.rpc"):
+			self.server.replay.respond_rpc(self, 'term', lambda: self.server.replay.course.term_json())
+		elif path.endswith("resourceRpcBean.getResourceTokenV2.rpc"):
+			biz_id = form.get('bizId', [''])[0]
+			self.server.replay.respond_rpc(self, 'signature', lambda: {"code": 0, "result": {"videoSignDto": {"signature": f"replay-{biz_id}"}}})
+		else:
+			self.server.replay.respond(self, 'other', 404)
+
+	def do_GET(self):
+		parts = urlsplit(self.path)
+		replay = self.server.replay
+		if parts.path == "/eds/api/v1/vod/video":
+			video_id = int(parse_qs(parts.query).get('videoId', ['0'])[0])
+			replay.respond_rpc(self, 'video_link', lambda: replay.vod_json(video_id))
+			return
+		match = re.match(r'^/hls/(\d+)/(.+)$', parts.path)
+		if not match:
+			replay.respond(self, 'other', 404)
+			return
+		video_id, name = int(match.group(1)), match.group(2)
+		if name == "index.m3u8":
+			text = replay.course.playlist(video_id)
+			replay.respond(self, 'playlist', 200 if text else 404, text.encode('utf-8') if text else b'', "application/vnd.apple.mpegurl")
+		else:
+			data = replay.course.segment(video_id, name)
+			replay.respond(self, 'segment', 200 if data is not None else 404, data or b'', "video/mp2t")
+
+class ReplayHTTPServer(ThreadingHTTPServer):
+	daemon_threads = True
+
+	def handle_error(self, request, client_address):
+		# 客户端关掉空闲的长连接或中途断开是正常情况，不打印堆栈
+		if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+			return
+		super().handle_error(request, client_address)
+
+class ReplayServer:
+	"""
+	本地替身服务器。course 为 SyntheticCourse 或 RecordedCourse。
+	latency 为 {'rpc'|'playlist'|'segment': 秒}，每个请求再乘以 [1-jitter, 1+jitter] 的随机系数；
+	bandwidth 为每个连接的下行速率(字节/秒)；error_rate 为返回 503 的概率，
+	truncate_rate 为分片只发一半就断开的概率(声明的 Content-Length 不变)。
+	接口和分片分别监听两个端口，和线上一样是不同的主机，连接池和按主机并发限制才能分开生效。
+	"""
+	def __init__(self, course=None, host="127.0.0.1", port=0, cdn_port=0, latency=None, jitter=0.0, bandwidth=None, error_rate=0.0, truncate_rate=0.0, seed=None):
+		self.course = course or SyntheticCourse()
+		self.latency = latency or {}
+		self.jitter = jitter
+		self.bandwidth = bandwidth
+		self.error_rate = error_rate
+		self.truncate_rate = truncate_rate
+		self._random = random.Random(seed)
+		self._lock = threading.Lock()
+		self.counts = {}
+		self.bytes_sent = 0
+		self.servers = []
+		for listen_port in (port, cdn_port):
+			httpd = ReplayHTTPServer((host, listen_port), ReplayHandler)
+			httpd.replay = self
+			self.servers.append(httpd)
+		self._threads = []
+
+	@staticmethod
+	def _url(httpd):
+		host, port = httpd.server_address[:2]
+		return f"http://{host}:{port}"
+
+	@property
+	def base_url(self):
+		"""接口(学期/签名/视频链接)地址"""
+		return self._url(self.servers[0])
+
+	@property
+	def cdn_url(self):
+		"""播放列表和分片地址"""
+		return self._url(self.servers[1])
+
+	def start(self):
+		for httpd in self.servers:
+			thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+			thread.start()
+			self._threads.append(thread)
+		return self
+
+	def stop(self):
+		for httpd in self.servers:
+			httpd.shutdown()
+			httpd.server_close()
+		for thread in self._threads:
+			thread.join()
+		self._threads = []
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *exc):
+		self.stop()
+
+	def env(self, cookies_file):
+		"""让 test.py 连到本服务器所需的环境变量"""
+		return {"ICOURSE_BASE": self.base_url, "ICOURSE_VOD_BASE": self.base_url, "ICOURSE_COOKIES": cookies_file}
+
+	def vod_json(self, video_id):
+		resp_json = self.course.vod_json(video_id)
+		if resp_json is None:
+			return {"code": -1, "message": "unknown video"}
+		# 所有清晰度都指向本地录下的那一份播放列表
+		for video in resp_json.get('result', {}).get('videos', []):
+			video['videoUrl'] = f"{self.cdn_url}/hls/{video_id}/index.m3u8"
+		return resp_json
+
+	def _chance(self, rate):
+		if not rate:
+			return False
+		with self._lock:
+			return self._random.random() < rate
+
+	def _delay(self, kind):
+		base = self.latency.get('rpc' if kind in ('term', 'signature', 'video_link') else kind, 0.0)
+		if base:
+			with self._lock:
+				factor = self._random.uniform(1 - self.jitter, 1 + self.jitter)
+			time.sleep(base * factor)
+
+	def _count(self, kind, status, nbytes):
+		with self._lock:
+			self.counts[(kind, status)] = self.counts.get((kind, status), 0) + 1
+			self.bytes_sent += nbytes
+
+	def respond_rpc(self, handler, kind, build):
+		if self._chance(self.error_rate):
+			self.respond(handler, kind, 503)
+			return
+		self.respond(handler, kind, 200, json.dumps(build(), ensure_ascii=False).encode('utf-8'), "application/json;charset=UTF-8")
+
+	def respond(self, handler, kind, status, body=b'', content_type="text/plain"):
+		self._delay(kind)
+		if status == 200 and kind in ('playlist', 'segment') and self._chance(self.error_rate):
+			status, body = 503, b''
+		start, end = 0, len(body)
+		if status == 200 and kind == 'segment':
+			byterange = re.match(r'bytes=(\d+)-(\d*)', handler.headers.get('Range') or '')
+			if byterange:
+				start = int(byterange.group(1))
+				end = min(len(body), int(byterange.group(2)) + 1) if byterange.group(2) else len(body)
+				status = 206
+		handler.send_response(status)
+		handler.send_header("Content-Type", content_type)
+		handler.send_header("Content-Length", str(end - start))
+		if status == 206:
+			handler.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(body)}")
+		handler.end_headers()
+		if kind == 'segment' and status in (200, 206) and self._chance(self.truncate_rate):
+			end = start + (end - start) // 2
+			handler.close_connection = True
+		self._count(kind, status, end - start)
+		self._send(handler, memoryview(body)[start:end])
+
+	def _send(self, handler, view, chunk=64 * 1024):
+		"""按每连接带宽限制分块发送"""
+		t0 = time.monotonic()
+		sent = 0
+		try:
+			while sent < len(view):
+				handler.wfile.write(view[sent:sent + chunk])
+				sent += min(chunk, len(view) - sent)
+				if self.bandwidth:
+					ahead = sent / self.bandwidth - (time.monotonic() - t0)
+					if ahead > 0:
+						time.sleep(ahead)
+		except (BrokenPipeError, ConnectionResetError):
+			handler.close_connection = True
+
+	def summary(self):
+		with self._lock:
+			counts = "，".join(f"{kind} {status}: {n}" for (kind, status), n in sorted(self.counts.items()))
+			return f"回放服务器：{counts}；共发送 {self.bytes_sent / 1048576:.1f}MB"
+
+# --- 配置区 ---
+# 录制目录；None 时使用 SyntheticCourse 生成的虚拟课程
+RECORDING_DIR = None
+PORT = 8163
+CDN_PORT = 8164
+
+if __name__ == "__main__":
+	course = RecordedCourse(RECORDING_DIR) if RECORDING_DIR else SyntheticCourse()
+	server = ReplayServer(course, port=PORT, cdn_port=CDN_PORT, latency={'rpc': 0.05, 'playlist': 0.02, 'segment': 0.03}, jitter=0.5)
+	print(f"回放服务器已启动: {server.base_url}，用以下环境变量运行 test.py：")
+	for key, value in server.env("<cookies.json 路径>").items():
+		print(f"  {key}={value}")
+	server.start()
+	try:
+		while True:
+			time.sleep(1)
+	except KeyboardInterrupt:
+		server.stop()
+		print(server.summary())
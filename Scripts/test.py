@@ -3,26 +3,153 @@ site: icourse163.org
 	description: 下载网易云课堂视频，支持多线程和断点续传，自动转码为mp4格式。
 """
 import requests
-from tqdm import tqdm
+from requests.adapters import HTTPAdapter
 import re
-import ast
 import json
 import time
 import hashlib
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import time
+import random
+import threading
+from urllib.parse import urlsplit, parse_qs, urljoin
+from collections import deque
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 # 首先准备好cookie和请求头.
+# 导入本模块不会读文件或发请求：cookie 在第一次请求时才读取，课程信息由 load_units 获取。
+
+# 接口地址和 cookie 文件；离线回放/基准测试时用环境变量指向本地替身服务器(见 replay_server.py)
+ICOURSE_BASE = os.environ.get("ICOURSE_BASE", "https://www.icourse163.org")
+VOD_BASE = os.environ.get("ICOURSE_VOD_BASE", "https://vod.study.163.com")
+COOKIES_FILE = os.environ.get("ICOURSE_COOKIES", r"e:\\CODE\\Test\\Files\\Cookies.json")
+
+_cookies = None
+_cookies_lock = threading.Lock()
 
-with open(r"e:\\CODE\\Test\\Files\\Cookies.json", "r", encoding="utf-8") as f:
-    Cookies = json.load(f)
+def get_cookies():
+	"""第一次调用时读取 COOKIES_FILE，之后复用"""
+	global _cookies
+	with _cookies_lock:
+		if _cookies is None:
+			with open(COOKIES_FILE, "r", encoding="utf-8") as f:
+				_cookies = json.load(f)
+		return _cookies
 
 headers = {
 	"Referer": "https://www.icourse163.org/learn/XHUN-1466082193?tid=1473254527",
 	"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:146.0) Gecko/20100101 Firefox/146.0"
 }
 
-def get_csrfkey(cookies):
+TARGET_DIR = "E:\\CODE\\Test\\Targets"
+
+# 分片级并发：每个视频内部同时下载的分片数
+SEGMENT_WORKERS = 8
+# 流式下载的块大小，以及所有视频共用的已下载未写盘内存上限
+CHUNK_SIZE = 256 * 1024
+MEMORY_BUDGET = 64 * 1024 * 1024
+# 下载引擎：'thread' 线程池 + requests；'async' asyncio + aiohttp
+ENGINE = 'thread'
+# 调度顺序：'course' 按课程顺序；'longest' 先读 m3u8 时长，最长的先下载
+SCHEDULE_ORDER = 'longest'
+# 所有视频共用的下载带宽上限(字节/秒)，None 为不限
+MAX_BANDWIDTH = None
+# 为True时分片直接按顺序写入 ffmpeg 的标准输入，不落地 .ts；失败时回退到先下载再转码
+PIPE_TO_FFMPEG = False
+# 清晰度策略：'max_resolution' 取最高分辨率；'smallest' 取体积最小的(讲义类视频高清没有意义，能省很多流量)
+QUALITY_POLICY = 'max_resolution'
+# 码率上限(比特/秒)，超过的清晰度/变体不选；None 为不限
+MAX_BITRATE = None
+# 下载遥测的 JSON lines 跟踪文件(每个请求一行)，None 为不写
+TRACE_FILE = None
+# 为True时用一条汇总进度代替各视频各自的进度条；LIVE_INTERVAL 为刷新间隔(秒)
+LIVE_VIEW = True
+LIVE_INTERVAL = 1.0
+# 为True时逐个分片校验：长度与 Content-Length 一致、每 188 字节一个 0x47 同步字节
+VERIFY_SEGMENTS = True
+# 单个分片出错(连接中断、5xx、校验失败)时的重试次数和首次退避(秒，之后翻倍)；用完才放弃整个视频
+SEGMENT_RETRIES = 3
+SEGMENT_RETRY_BACKOFF = 0.5
+# 内容寻址的分片仓库目录，多门课程/重新上传的相同分片只下载和保存一次；None 为不启用
+SEGMENT_STORE = None
+
+class PooledSession:
+	"""
+	所有线程共用的 requests.Session，按主机挂载长连接池，避免每个请求都重新握手。
+	RPC主机(www.icourse163.org / vod.study.163.com)的池大小等于视频级并发数，
+	其余主机(分片CDN)的池大小等于视频级并发数 × 分片级并发数。
+	"""
+	RPC_HOSTS = (ICOURSE_BASE, VOD_BASE)
+
+	def __init__(self, max_workers=5, seg_workers=None):
+		self.session = requests.Session()
+		self.session.headers.update(headers)
+		self._has_cookies = False
+		self._lock = threading.Lock()
+		self._adapters = []
+		self._retired = {'opened': 0, 'requests': 0}
+		self.resize(max_workers, seg_workers)
+
+	def resize(self, max_workers, seg_workers=None):
+		"""按并发数重建连接池，旧池的计数累加保留；seg_workers 默认取当前的 SEGMENT_WORKERS"""
+		seg_workers = seg_workers or SEGMENT_WORKERS
+		with self._lock:
+			for adapter in self._adapters:
+				opened, sent = self._pool_counts(adapter)
+				self._retired['opened'] += opened
+				self._retired['requests'] += sent
+				adapter.close()
+			rpc_adapter = HTTPAdapter(pool_connections=len(self.RPC_HOSTS), pool_maxsize=max_workers)
+			cdn_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=max_workers * seg_workers)
+			self.session.mount("https://", cdn_adapter)
+			self.session.mount("http://", cdn_adapter)
+			for host in self.RPC_HOSTS:
+				# 带上末尾斜杠，避免 http://h:81 误匹配 http://h:8164 这样的其它端口
+				self.session.mount(host.rstrip('/') + '/', rpc_adapter)
+			self._adapters = [rpc_adapter, cdn_adapter]
+
+	@staticmethod
+	def _pool_counts(adapter):
+		opened = sent = 0
+		pools = adapter.poolmanager.pools
+		for key in list(pools.keys()):
+			pool = pools.get(key)
+			if pool is not None:
+				opened += pool.num_connections
+				sent += pool.num_requests
+		return opened, sent
+
+	def stats(self):
+		"""返回 {'opened': 新建连接数, 'reused': 复用连接的请求数}"""
+		with self._lock:
+			opened = self._retired['opened']
+			sent = self._retired['requests']
+			for adapter in self._adapters:
+				o, r = self._pool_counts(adapter)
+				opened += o
+				sent += r
+		return {'opened': opened, 'reused': max(sent - opened, 0)}
+
+	def _ensure_cookies(self):
+		if not self._has_cookies:
+			with self._lock:
+				if not self._has_cookies:
+					self.session.cookies.update(get_cookies())
+					self._has_cookies = True
+
+	def get(self, url, **kwargs):
+		self._ensure_cookies()
+		return self.session.get(url, **kwargs)
+
+	def post(self, url, **kwargs):
+		self._ensure_cookies()
+		return self.session.post(url, **kwargs)
+
+http = PooledSession()
+
+def get_csrfkey(cookies=None):
+	"""cookie 里的 NTESSTUDYSI 即 csrfKey；不传 cookies 时用 get_cookies()"""
+	if cookies is None:
+		cookies = get_cookies()
 	csrfkey = ""
 	for key, value in cookies.items():
 		if key == "NTESSTUDYSI":
@@ -30,36 +157,52 @@ def get_csrfkey(cookies):
 			break
 	return csrfkey
 
-# 此时已经获得tid和csrfkey
+# 默认下载的学期
 tid = 1473254527
-csrfkey = get_csrfkey(Cookies)
 
 # 考虑到可能出岔子,先获取整个学期的课程分布
-def term_avail(csrfkey,tid):
+def term_avail(csrfkey,tid,referer=None):
+	"""学期信息(解析后的 JSON)；和其他 RPC 一样经 call_rpc 限速、退避重试，重试耗尽时抛出 RpcError"""
+	url = f"{ICOURSE_BASE}/web/j/courseBean.getLastLearnedMocTermDto.rpc?csrfKey={csrfkey}"
 	data = {"termId": f"{tid}"}
-	response = requests.post(f"https://www.icourse163.org/web/j/courseBean.getLastLearnedMocTermDto.rpc?csrfKey={csrfkey}",headers=headers, data=data,cookies=Cookies)
-	response.close()
-	response = response.text
-	return response
+	# 多课程模式下每个学期用自己的课程页作 Referer，不传则沿用默认请求头
+	extra_headers = {"Referer": referer} if referer else None
+	resp_json = call_rpc('term', lambda: http.post(url, data=data, headers=extra_headers))
+	if resp_json is None:
+		raise RpcError(f"学期 {tid} 信息获取失败")
+	return resp_json
 
-term_data = term_avail(csrfkey,tid)
+def get_chapters(term_json):
+	"""从 term_avail 返回的 JSON 中取出章节列表"""
+	return term_json["result"]["mocTermDto"]["chapters"]
 
-def get_chapters(term_data):
-	term_json = json.loads(term_data)
-	chapter = str(term_json["result"]["mocTermDto"]["chapters"])
-	return chapter
+class VideoUnit:
+	"""一个视频单元：contentId(即videoId)、bizid、显示名、所在章/课的序号，以及所属学期和输出目录"""
+	__slots__ = ('content_id', 'bizid', 'name', 'chapter_idx', 'lesson_idx', 'term_id', 'target_dir')
 
-chapter = get_chapters(term_data)
-data = ast.literal_eval(chapter)
-data = json.loads(json.dumps(data, indent=2, ensure_ascii=False))
+	def __init__(self, content_id, bizid, name, chapter_idx, lesson_idx, term_id=None, target_dir=TARGET_DIR):
+		self.content_id = content_id
+		self.bizid = bizid
+		self.name = name
+		self.chapter_idx = chapter_idx
+		self.lesson_idx = lesson_idx
+		self.term_id = term_id
+		self.target_dir = target_dir
 
-def get_video_content_ids(data):
+	@property
+	def filepath(self):
+		return os.path.join(self.target_dir, f"{self.name}.mp4")
+
+	def __repr__(self):
+		return f"VideoUnit({self.content_id}, {self.bizid}, {self.name!r})"
+
+def get_video_units(data, term_id=None, target_dir=TARGET_DIR):
 	"""
-	Traverse the chapters/lessons/units structure and return a list of all contentId bizid, names.
+	Traverse the chapters/lessons/units structure once and return a list of VideoUnit records in course order.
+	Workers receive whole records, so no module-level contentId index is kept; a caller that needs lookups
+	builds one per batch with {u.content_id: u for u in units}.
 	"""
-	content_ids = []
-	bizids = []
-	names = []
+	units = []
 	seq_pattern = re.compile(r'^(第?([一二三四五六七八九十百千万0-9]+)[讲节章课单元回])|^([0-9]+(\.[0-9]+)*|[一二三四五六七八九十百千万]+)[、.．\s-]*|[?？\\\/:*"<>\|]')
 	unit_num = 1
 	for chapter in data:
@@ -70,141 +213,2153 @@ def get_video_content_ids(data):
 		for lesson in lessons:
 			for unit in lesson.get("units", []):
 				if unit.get("contentType") == 1 and unit.get("contentId") is not None:
-					content_ids.append(unit["contentId"])
-					bizids.append(unit["id"])
 					raw_name = unit['name']
 					name = seq_pattern.sub('', raw_name).strip()
-					names.append(f"{unit_num}.{lessen_num} {name}")
+					units.append(VideoUnit(unit["contentId"], unit["id"], f"{unit_num}.{lessen_num} {name}", unit_num, lessen_num, term_id, target_dir))
 			lessen_num += 1
 		unit_num += 1
-	return content_ids, bizids, names
+	return units
 
-videoids, bizids, names = get_video_content_ids(data)
+def get_video_content_ids(data):
+	"""
+	Traverse the chapters/lessons/units structure and return a list of all contentId bizid, names.
+	"""
+	units = get_video_units(data)
+	return [u.content_id for u in units], [u.bizid for u in units], [u.name for u in units]
 
-def get_signature(bizid,csrfkey):
+def load_units(term_id=tid, referer=None, target_dir=TARGET_DIR):
+	"""获取一个学期的章节树并生成 VideoUnit 列表(会发请求)"""
+	return get_video_units(get_chapters(term_avail(get_csrfkey(), term_id, referer)), term_id=term_id, target_dir=target_dir)
+
+def signature_params(bizid):
 	string = f"{bizid}1{int(time.time() * 1000)}881mooc1543989727"
 	sign = hashlib.md5(string.encode('utf-8')).hexdigest()
 	timestamp = int(time.time() * 1000)
-	params2 = {
+	return {
 		"bizId": bizid,
 		"bizType": "1",
 		"contentType": "1",
 		"sign": sign,
 		"timestamp": timestamp
 	}
-	url = f"https://www.icourse163.org/web/j/resourceRpcBean.getResourceTokenV2.rpc?csrfKey={csrfkey}"
-	resp=requests.post(url,headers=headers,data=params2,cookies=Cookies)
-	resp.close()
-	resp_json=resp.json()
-	if resp_json['code'] == 0:
+
+class LatencyHistogram:
+	"""按 2 的幂分桶的耗时直方图(毫秒)，只存桶计数，分位数取桶上界"""
+	BUCKETS = [2 ** i for i in range(18)]  # 1ms .. 131s
+
+	def __init__(self):
+		self.counts = [0] * (len(self.BUCKETS) + 1)
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def add(self, ms):
+		idx = 0
+		while idx < len(self.BUCKETS) and ms > self.BUCKETS[idx]:
+			idx += 1
+		self.counts[idx] += 1
+		self.count += 1
+		self.total += ms
+		self.max = max(self.max, ms)
+
+	def percentile(self, q):
+		if not self.count:
+			return 0.0
+		rank = q * self.count
+		seen = 0
+		for idx, n in enumerate(self.counts):
+			seen += n
+			if seen >= rank:
+				return min(float(self.BUCKETS[idx]), self.max) if idx < len(self.BUCKETS) else self.max
+		return self.max
+
+	def bars(self):
+		"""非空桶的分布，如 '≤64ms:12 ≤128ms:30'"""
+		labels = [f"≤{b}ms" for b in self.BUCKETS] + [f">{self.BUCKETS[-1]}ms"]
+		return " ".join(f"{labels[idx]}:{n}" for idx, n in enumerate(self.counts) if n)
+
+class Telemetry:
+	"""
+	下载遥测：按阶段(signature / video_link / playlist / segment / remux)记录请求耗时直方图、
+	各下载线程和总体的字节数、各阶段重试次数，并可把每个请求写成一行 JSON 到跟踪文件。
+	线程引擎按下载线程统计速率，asyncio 引擎按视频统计。
+	"""
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._trace = None
+		self.reset()
+
+	def reset(self, trace_file=None):
+		with self._lock:
+			if self._trace:
+				self._trace.close()
+			self._trace = open(trace_file, 'a', encoding='utf-8') if trace_file else None
+			self.started = time.monotonic()
+			self.histograms = {}
+			self.retries = {}
+			self.bytes_total = 0
+			# worker -> [字节数, 首次记录时间, 最近记录时间]
+			self.workers = {}
+			self.segments_total = 0
+			self.segments_done = 0
+
+	def _write(self, event):
+		if self._trace:
+			event['ts'] = round(time.time(), 3)
+			self._trace.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+	def record(self, phase, seconds, nbytes=0, ok=True, worker=None, **fields):
+		"""记录一次请求；fields 原样写入跟踪文件"""
+		ms = seconds * 1000
+		now = time.monotonic()
+		with self._lock:
+			hist = self.histograms.get(phase)
+			if hist is None:
+				hist = self.histograms[phase] = LatencyHistogram()
+			hist.add(ms)
+			if nbytes:
+				self.bytes_total += nbytes
+				stat = self.workers.setdefault(worker or threading.current_thread().name, [0, now - seconds, now])
+				stat[0] += nbytes
+				stat[2] = now
+			if phase == 'segment' and ok:
+				self.segments_done += 1
+			self._write(dict(phase=phase, ms=round(ms, 1), bytes=nbytes, ok=ok, worker=worker or threading.current_thread().name, **fields))
+
+	def retry(self, phase, **fields):
+		with self._lock:
+			self.retries[phase] = self.retries.get(phase, 0) + 1
+			self._write(dict(phase=phase, event='retry', **fields))
+
+	def expect(self, segments):
+		"""登记即将下载的分片数，用于汇总进度"""
+		with self._lock:
+			self.segments_total += segments
+
+	def snapshot(self):
+		with self._lock:
+			seg = self.histograms.get('segment')
+			return {
+				'elapsed': time.monotonic() - self.started,
+				'bytes': self.bytes_total,
+				'segments_done': self.segments_done,
+				'segments_total': self.segments_total,
+				'retries': sum(self.retries.values()),
+				'segment_p95': seg.percentile(0.95) if seg else 0.0,
+			}
+
+	def close(self):
+		with self._lock:
+			if self._trace:
+				self._trace.close()
+				self._trace = None
+
+	def summary(self):
+		with self._lock:
+			elapsed = max(time.monotonic() - self.started, 1e-9)
+			lines = [f"遥测：共 {self.bytes_total / 1048576:.1f}MB，用时 {elapsed:.1f}s，平均 {self.bytes_total / elapsed / 1048576:.2f}MB/s"]
+			for phase, hist in self.histograms.items():
+				lines.append(
+					f"  {phase}: {hist.count} 次，平均 {hist.total / hist.count:.0f}ms，"
+					f"p50 {hist.percentile(0.5):.0f}ms，p95 {hist.percentile(0.95):.0f}ms，p99 {hist.percentile(0.99):.0f}ms，最大 {hist.max:.0f}ms"
+				)
+				lines.append(f"    {hist.bars()}")
+			for worker, (nbytes, first, last) in sorted(self.workers.items()):
+				lines.append(f"  {worker}: {nbytes / 1048576:.1f}MB，{nbytes / max(last - first, 1e-9) / 1048576:.2f}MB/s")
+			if self.retries:
+				lines.append("  重试：" + "，".join(f"{phase} {n}" for phase, n in self.retries.items()))
+		return "\n".join(lines)
+
+telemetry = Telemetry()
+
+class LiveView:
+	"""后台线程定时把遥测汇总刷新到一条进度条上，代替各视频交错的进度条"""
+	def __init__(self, source=None, interval=LIVE_INTERVAL):
+		self.source = source or telemetry
+		self.interval = interval
+		self._stop = threading.Event()
+		self._thread = threading.Thread(target=self._run, daemon=True)
+
+	def start(self):
+		self._thread.start()
+
+	def _run(self):
+		from tqdm import tqdm
+		last_bytes, last_time = 0, time.monotonic()
+		with tqdm(total=0, unit='seg', desc="总进度") as bar:
+			while not self._stop.wait(self.interval):
+				self._refresh(bar, last_bytes, last_time)
+				last_bytes, last_time = self.source.bytes_total, time.monotonic()
+			self._refresh(bar, last_bytes, last_time)
+
+	def _refresh(self, bar, last_bytes, last_time):
+		snap = self.source.snapshot()
+		rate = (snap['bytes'] - last_bytes) / max(time.monotonic() - last_time, 1e-9)
+		bar.total = snap['segments_total']
+		bar.n = snap['segments_done']
+		bar.set_postfix_str(f"{rate / 1048576:.2f}MB/s 分片p95 {snap['segment_p95']:.0f}ms 重试 {snap['retries']}", refresh=False)
+		bar.refresh()
+
+	def stop(self):
+		self._stop.set()
+		self._thread.join()
+
+def start_telemetry(trace_file=TRACE_FILE, live_view=LIVE_VIEW):
+	"""清零遥测并按需启动汇总进度，返回 LiveView(未启用时为 None)"""
+	telemetry.reset(trace_file)
+	live = LiveView() if live_view else None
+	if live:
+		live.start()
+	return live
+
+def stop_telemetry(live):
+	if live:
+		live.stop()
+	telemetry.close()
+	print(telemetry.summary())
+
+class AdaptiveRateLimiter:
+	"""
+	单个RPC端点的令牌桶限速，速率按 AIMD 自适应：
+	请求成功时速率加 increase，被限流或出错时速率乘以 decrease，始终夹在 [min_rate, max_rate] 内。
+	"""
+	def __init__(self, rate=5.0, burst=5, min_rate=0.5, max_rate=50.0, increase=0.5, decrease=0.5):
+		self.rate = rate
+		self.burst = burst
+		self.min_rate = min_rate
+		self.max_rate = max_rate
+		self.increase = increase
+		self.decrease = decrease
+		self.tokens = burst
+		self.updated = time.monotonic()
+		self._lock = threading.Lock()
+
+	def reserve(self):
+		"""预订一个令牌，返回还需等待的秒数；令牌可以透支，透支部分按当前速率折算成等待时间"""
+		with self._lock:
+			now = time.monotonic()
+			self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+			self.updated = now
+			self.tokens -= 1
+			return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+	def acquire(self):
+		wait = self.reserve()
+		if wait:
+			time.sleep(wait)
+
+	async def acquire_async(self):
+		import asyncio
+		wait = self.reserve()
+		if wait:
+			await asyncio.sleep(wait)
+
+	def on_success(self):
+		with self._lock:
+			self.rate = min(self.max_rate, self.rate + self.increase)
+
+	def on_error(self):
+		with self._lock:
+			self.rate = max(self.min_rate, self.rate * self.decrease)
+
+# 每个RPC端点一个限速器
+rate_limiters = {
+	'term': AdaptiveRateLimiter(),
+	'signature': AdaptiveRateLimiter(),
+	'video_link': AdaptiveRateLimiter(),
+}
+RPC_MAX_ATTEMPTS = 5
+
+class RpcError(Exception):
+	"""RPC 返回非0 code 或 HTTP 429/5xx，可以退避后重试"""
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+	"""带随机抖动(full jitter)的指数退避时长"""
+	return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def check_rpc_response(status, resp_json):
+	if status == 429 or status >= 500:
+		raise RpcError(f"HTTP {status}")
+	if resp_json.get('code') != 0:
+		raise RpcError(f"code={resp_json.get('code')}")
+	return resp_json
+
+def call_rpc(endpoint, send, max_attempts=RPC_MAX_ATTEMPTS):
+	"""
+	限速并按请求退避重试；send() 每次重新构造并发出请求，返回 requests.Response。
+	重试耗尽后返回 None。
+	"""
+	limiter = rate_limiters[endpoint]
+	for attempt in range(max_attempts):
+		limiter.acquire()
+		t0 = time.perf_counter()
+		try:
+			resp = send()
+			resp.close()
+			resp_json = check_rpc_response(resp.status_code, resp.json())
+		except (RpcError, requests.RequestException, ValueError) as e:
+			telemetry.record(endpoint, time.perf_counter() - t0, ok=False, error=str(e))
+			limiter.on_error()
+			if attempt + 1 < max_attempts:
+				telemetry.retry(endpoint)
+				time.sleep(backoff_delay(attempt))
+			else:
+				print(f"{endpoint} 请求失败: {e}")
+			continue
+		telemetry.record(endpoint, time.perf_counter() - t0)
+		limiter.on_success()
+		return resp_json
+	return None
+
+def get_signature(bizid,csrfkey):
+	url = f"{ICOURSE_BASE}/web/j/resourceRpcBean.getResourceTokenV2.rpc?csrfKey={csrfkey}"
+	# 签名参数带时间戳，每次重试都要重新生成
+	resp_json = call_rpc('signature', lambda: http.post(url, data=signature_params(bizid)))
+	if resp_json:
 		signature = resp_json['result']['videoSignDto']['signature']
 		return signature
 	else:
 		return None
 
+VIDEO_API = f"{VOD_BASE}/eds/api/v1/vod/video"
+
+def _number(value):
+	try:
+		return float(value or 0)
+	except (TypeError, ValueError):
+		return 0.0
+
+def choose_quality(options, policy=QUALITY_POLICY, max_bitrate=MAX_BITRATE):
+	"""
+	options 为 [(候选, {'pixels', 'bitrate', 'size'})]，按策略选一个候选。
+	有码率上限时先排除超出的(未知码率的保留)；全部超出时退而取码率最低的。
+	"""
+	if max_bitrate:
+		allowed = [o for o in options if not o[1]['bitrate'] or o[1]['bitrate'] <= max_bitrate]
+		if not allowed:
+			return min(options, key=lambda o: o[1]['bitrate'])[0]
+		options = allowed
+	if policy == 'smallest':
+		return min(options, key=lambda o: (o[1]['size'] or o[1]['bitrate'], o[1]['pixels']))[0]
+	return max(options, key=lambda o: (o[1]['pixels'], o[1]['bitrate']))[0]
+
+def select_video(videos, policy=QUALITY_POLICY, max_bitrate=MAX_BITRATE):
+	"""从接口返回的多个清晰度里选一个，返回其 videoUrl；优先 m3u8 格式"""
+	hls = [v for v in videos if v.get('format') == 'hls' or '.m3u8' in (v.get('videoUrl') or '')]
+	options = []
+	for v in hls or videos:
+		pixels = _number(v.get('width')) * _number(v.get('height')) or _number(v.get('quality'))
+		bitrate = _number(v.get('bitrate') or v.get('bitRate'))
+		options.append((v, {'pixels': pixels, 'bitrate': bitrate, 'size': _number(v.get('size'))}))
+	return choose_quality(options, policy, max_bitrate)['videoUrl']
+
 def get_video_link(videoid,signature):
-	baseurl = "https://vod.study.163.com/eds/api/v1/vod/video"
+	baseurl = VIDEO_API
 	params = {"videoId": videoid,
 			  "signature": signature,
 			  "clientType": 1}
-	videoreq = requests.get(baseurl,params = params, cookies= Cookies, headers=headers)
-	if videoreq.json()['code'] == 0:
-		return videoreq.json()['result']['videos'][0]['videoUrl']
+	resp_json = call_rpc('video_link', lambda: http.get(baseurl, params=params))
+	if resp_json:
+		return select_video(resp_json['result']['videos'])
 	else:
 		print("链接获取失败!")
 
-def m3u8_2_mp4(m3u8_link, filename):
+# 签名和 m3u8 链接的缓存有效期(秒)；链接自带过期时间戳时以其为准，并提前 LINK_EXPIRY_MARGIN 秒失效
+SIGNATURE_TTL = 300
+LINK_TTL = 600
+LINK_EXPIRY_MARGIN = 60
+# 后台预取链接时，最多领先下载线程多少个视频
+PREFETCH_AHEAD = 5
+
+def link_expiry(link, ttl=LINK_TTL):
+	"""估计链接的过期时刻(epoch 秒)"""
+	now = time.time()
+	for key, values in parse_qs(urlsplit(link).query).items():
+		value = values[0]
+		if key.lower() in ('expires', 'expire', 'wstime', 'e') and value.isdigit() and len(value) == 10 and int(value) > now:
+			return int(value) - LINK_EXPIRY_MARGIN
+	return now + ttl
+
+class LinkCache:
+	"""
+	签名(按 bizid)和 m3u8 链接(按 videoId)的缓存，带过期时间。
+	同一视频同时只有一个线程在解析，预取线程和下载线程不会重复请求。
+	"""
+	def __init__(self, signature_ttl=SIGNATURE_TTL, link_ttl=LINK_TTL):
+		self.signature_ttl = signature_ttl
+		self.link_ttl = link_ttl
+		self._entries = {}
+		self._lock = threading.Lock()
+		self._key_locks = {}
+
+	def _get(self, key):
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry and entry[1] > time.time():
+				return entry[0]
+			self._entries.pop(key, None)
+			return None
+
+	def _put(self, key, value, expires_at):
+		with self._lock:
+			self._entries[key] = (value, expires_at)
+
+	def _key_lock(self, content_id):
+		with self._lock:
+			return self._key_locks.setdefault(content_id, threading.Lock())
+
+	def cached_link(self, unit):
+		return self._get(('link', unit.content_id))
+
+	def store(self, unit, signature, link):
+		"""
+		signature 只传刚请求到的签名(从缓存取的传 None，免得每次复用都续期)；
+		拿不到链接说明签名可能已被拒绝，缓存里的签名一并丢掉。
+		"""
+		if not link:
+			with self._lock:
+				self._entries.pop(('sig', unit.bizid), None)
+			return
+		if signature:
+			self._put(('sig', unit.bizid), signature, time.time() + self.signature_ttl)
+		self._put(('link', unit.content_id), link, link_expiry(link, self.link_ttl))
+
+	def resolve(self, unit):
+		"""返回 m3u8 链接，优先用缓存；失败返回 None"""
+		with self._key_lock(unit.content_id):
+			link = self.cached_link(unit)
+			if link:
+				return link
+			cached = self._get(('sig', unit.bizid))
+			signature = cached or get_signature(unit.bizid, get_csrfkey())
+			link = get_video_link(unit.content_id, signature) if signature else None
+			self.store(unit, None if cached else signature, link)
+			return link
+
+	def invalidate(self, unit):
+		"""链接被服务器拒绝时丢弃，下次重新解析"""
+		with self._lock:
+			self._entries.pop(('link', unit.content_id), None)
+			self._entries.pop(('sig', unit.bizid), None)
+
+link_cache = LinkCache()
+
+class LinkPrefetcher:
+	"""
+	后台线程：按下载队列顺序提前解析链接，最多领先下载线程 lookahead 个视频，
+	让签名和链接 RPC 离开下载的关键路径。
+	"""
+	def __init__(self, units, cache=None, lookahead=PREFETCH_AHEAD):
+		self.units = list(units)
+		self.cache = cache or link_cache
+		self._slots = threading.Semaphore(lookahead)
+		self._lock = threading.Lock()
+		self._pending = set()
+		self._started = set()
+		self._stopped = threading.Event()
+		self._thread = threading.Thread(target=self._run, daemon=True)
+
+	def start(self):
+		self._thread.start()
+
+	def _run(self):
+		for unit in self.units:
+			# 等待领先数量降下来；定期醒来检查是否已停止
+			while not self._slots.acquire(timeout=0.5):
+				if self._stopped.is_set():
+					return
+			if self._stopped.is_set():
+				return
+			with self._lock:
+				skip = unit.content_id in self._started or unit.name in get_ledger(unit.target_dir)
+			if skip:
+				self._slots.release()
+				continue
+			try:
+				self.cache.resolve(unit)
+			except Exception as e:
+				print(f"{unit.name} 预取链接失败: {e}")
+			with self._lock:
+				if unit.content_id in self._started:
+					self._slots.release()
+				else:
+					self._pending.add(unit.content_id)
+
+	def started(self, unit):
+		"""下载线程开始处理某个视频时调用，释放它占用的领先名额"""
+		with self._lock:
+			self._started.add(unit.content_id)
+			if unit.content_id in self._pending:
+				self._pending.discard(unit.content_id)
+				self._slots.release()
+
+	def stop(self):
+		self._stopped.set()
+		self._thread.join()
+
+class _SpareBuffer(bytearray):
+	"""预算耗尽时为队头分片临时分配的缓冲区，归还时直接丢弃"""
+
+class BufferPool:
+	"""
+	全局内存预算：所有视频的分片下载线程共用一组 chunk_size 大小的可复用缓冲区，
+	池中缓冲区用完时下载线程阻塞等待写盘线程归还，已下载未写盘的数据总量不超过 budget。
+	"""
+	def __init__(self, budget=MEMORY_BUDGET, chunk_size=CHUNK_SIZE):
+		self.cond = threading.Condition()
+		self.configure(budget, chunk_size)
+
+	def configure(self, budget, chunk_size):
+		with self.cond:
+			self.chunk_size = chunk_size
+			self.capacity = max(budget // chunk_size, 1)
+			self.allocated = 0
+			self.free = []
+			self.cond.notify_all()
+
+	def try_take(self, urgent=False):
+		"""须持有 cond 调用；没有可用缓冲区时返回 None，urgent 时临时分配一个"""
+		if self.free:
+			return self.free.pop()
+		if self.allocated < self.capacity:
+			self.allocated += 1
+			return bytearray(self.chunk_size)
+		if urgent:
+			return _SpareBuffer(self.chunk_size)
+		return None
+
+	def give(self, buf):
+		"""须持有 cond 调用"""
+		if type(buf) is bytearray and len(buf) == self.chunk_size:
+			self.free.append(buf)
+		self.cond.notify_all()
+
+buffer_pool = BufferPool()
+
+class BandwidthLimiter:
+	"""全局带宽令牌桶(字节/秒)，所有课程、所有视频的分片下载共用；rate 为 None 时不限速"""
+	def __init__(self, rate=MAX_BANDWIDTH):
+		self._lock = threading.Lock()
+		self.configure(rate)
+
+	def configure(self, rate):
+		with self._lock:
+			self.rate = rate
+			# 最多积攒一秒的突发
+			self.tokens = rate or 0
+			self.updated = time.monotonic()
+
+	def reserve(self, n):
+		"""记下 n 字节，返回需要等待的秒数"""
+		with self._lock:
+			if not self.rate:
+				return 0.0
+			now = time.monotonic()
+			self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+			self.updated = now
+			self.tokens -= n
+			return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+	def consume(self, n):
+		wait = self.reserve(n)
+		if wait:
+			time.sleep(wait)
+
+	async def consume_async(self, n):
+		import asyncio
+		wait = self.reserve(n)
+		if wait:
+			await asyncio.sleep(wait)
+
+bandwidth = BandwidthLimiter()
+
+class SegmentIntegrityError(Exception):
+	"""分片长度不符或不是合法的 TS 数据，可以重新下载"""
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+
+class SegmentVerifier:
+	"""
+	边下载边校验一个分片：明文每 188 字节的包头必须是同步字节 0x47，结束时核对长度；
+	需要时顺带计算 sha256 作为分片仓库的内容地址。
+	"""
+	def __init__(self, url, check_sync=True, digest=False):
+		self.url = url
+		# fMP4 等非 TS 分片没有同步字节
+		self.check_sync = check_sync and not urlsplit(url).path.endswith(('.m4s', '.mp4', '.aac'))
+		self._hash = hashlib.sha256() if digest else None
+		self.size = 0
+
+	def feed(self, data):
+		if self.check_sync and data:
+			# 本块内第一个包头的位置，之后每隔 188 字节一个
+			first = -self.size % TS_PACKET_SIZE
+			heads = data[first::TS_PACKET_SIZE]
+			if heads.count(TS_SYNC_BYTE) != len(heads):
+				raise SegmentIntegrityError(f"TS 同步字节错误: {self.url}")
+		if self._hash:
+			self._hash.update(data)
+		self.size += len(data)
+
+	def finish(self, received=None, expected=None):
+		"""received/expected 为实际收到和响应头声明的(加密)字节数"""
+		if expected is not None and received != int(expected):
+			raise SegmentIntegrityError(f"分片不完整: 收到 {received}/{expected} 字节 {self.url}")
+		if not self.size:
+			raise SegmentIntegrityError(f"空分片: {self.url}")
+		if self.check_sync and self.size % TS_PACKET_SIZE:
+			raise SegmentIntegrityError(f"TS 长度不是 188 的整数倍: {self.url}")
+
+	def hexdigest(self):
+		return self._hash.hexdigest() if self._hash else None
+
+def expected_length(headers):
+	"""响应声明的正文长度；内容经过压缩时解压后长度不同，不做核对"""
+	if headers.get('Content-Encoding'):
+		return None
+	return headers.get('Content-Length')
+
+class SegmentStore:
+	"""
+	内容寻址的分片仓库：解密后的分片按 sha256 存在 objects/ 下，相同内容只存一份；
+	index.jsonl 记录 分片键(CDN路径+字节范围，不含会变的查询参数) -> sha256，命中的分片直接从本地读取。
+	同一视频出现在多门课程或重新下载时只下载一次；重新上传的视频路径不同，但内容相同的分片仍只存一份。
+	"""
+	def __init__(self, root=SEGMENT_STORE):
+		self._lock = threading.Lock()
+		self.configure(root)
+
+	def configure(self, root):
+		with self._lock:
+			self.root = root
+			self._index = None
+			self.hits = 0
+			self.stored = 0
+			self.duplicates = 0
+
+	@property
+	def enabled(self):
+		return bool(self.root)
+
+	@staticmethod
+	def key(segment):
+		path = urlsplit(segment.url).path
+		if segment.byterange:
+			return f"{path}@{segment.byterange[0]}-{segment.byterange[1]}"
+		return path
+
+	def _object_path(self, digest):
+		return os.path.join(self.root, "objects", digest[:2], digest)
+
+	def _load(self):
+		# 须持有 _lock 调用
+		if self._index is not None:
+			return
+		self._index = {}
+		path = os.path.join(self.root, "index.jsonl")
+		if os.path.exists(path):
+			with open(path, 'r', encoding='utf-8') as f:
+				for line in f:
+					try:
+						entry = json.loads(line)
+						self._index[entry['key']] = (entry['sha256'], entry['size'])
+					except (ValueError, KeyError, TypeError):
+						continue  # 写入时被中断的残行
+
+	def lookup(self, segment):
+		"""返回仓库里该分片的文件路径，没有或大小不符时返回 None"""
+		if not self.enabled:
+			return None
+		with self._lock:
+			self._load()
+			entry = self._index.get(self.key(segment))
+		if not entry:
+			return None
+		digest, size = entry
+		path = self._object_path(digest)
+		try:
+			if os.path.getsize(path) != size:
+				return None
+		except OSError:
+			return None
+		with self._lock:
+			self.hits += 1
+		return path
+
+	def open_temp(self):
+		"""新建一个独占的临时文件，返回 (路径, 文件对象)；asyncio 引擎的分片都在同一线程里，不能靠线程号和时钟区分"""
+		import tempfile
+		tmp_dir = os.path.join(self.root, "tmp")
+		os.makedirs(tmp_dir, exist_ok=True)
+		fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+		return tmp_path, os.fdopen(fd, 'wb')
+
+	def commit(self, segment, tmp_path, digest, size):
+		"""把写完的临时文件存为对象(已有相同内容时丢弃)，并记入索引"""
+		path = self._object_path(digest)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with self._lock:
+			if os.path.exists(path):
+				os.remove(tmp_path)
+				self.duplicates += 1
+			else:
+				os.replace(tmp_path, path)
+				self.stored += 1
+			self._load()
+			key = self.key(segment)
+			self._index[key] = (digest, size)
+			with open(os.path.join(self.root, "index.jsonl"), 'a', encoding='utf-8') as f:
+				f.write(json.dumps({'key': key, 'sha256': digest, 'size': size}) + "\n")
+
+	def discard(self, segment):
+		"""仓库里的分片校验失败：删掉对象和索引项，下次重新下载"""
+		with self._lock:
+			self._load()
+			entry = self._index.pop(self.key(segment), None)
+		if entry and os.path.exists(self._object_path(entry[0])):
+			os.remove(self._object_path(entry[0]))
+
+	def summary(self):
+		return f"分片仓库：命中 {self.hits}，新存 {self.stored}，内容重复 {self.duplicates}"
+
+segment_store = SegmentStore()
+
+class SegmentPipeline:
+	"""
+	分片乱序下载、按播放列表顺序写入。
+	每个分片对应一个槽位，下载线程把 iter_content 的数据块拷进池中缓冲区后放入槽位，
+	写盘线程只消费当前队头槽位(next_idx)，边下边写。
+	队头分片在预算耗尽时可临时分配缓冲区(最多积压两块)，避免被后面的分片饿死。
+	"""
+	def __init__(self, count, pool=None):
+		self.pool = pool or buffer_pool
+		self._cond = self.pool.cond
+		self.slots = [deque() for _ in range(count)]
+		self.finished = [False] * count
+		self.next_idx = 0
+		self.error = None
+
+	def take_buffer(self, idx):
+		with self._cond:
+			while True:
+				if self.error:
+					raise RuntimeError("分片下载已中止")
+				urgent = idx == self.next_idx and len(self.slots[idx]) < 2
+				buf = self.pool.try_take(urgent)
+				if buf is not None:
+					return buf
+				self._cond.wait()
+
+	def put(self, idx, buf, n):
+		with self._cond:
+			if self.error:
+				self.pool.give(buf)
+				raise RuntimeError("分片下载已中止")
+			self.slots[idx].append((buf, n))
+			self._cond.notify_all()
+
+	def write(self, idx, data):
+		"""把一段数据拷进池中缓冲区，按缓冲区大小切块放入槽位"""
+		view = memoryview(data)
+		while view:
+			buf = self.take_buffer(idx)
+			n = min(len(buf), len(view))
+			buf[:n] = view[:n]
+			self.put(idx, buf, n)
+			view = view[n:]
+
+	def finish(self, idx):
+		with self._cond:
+			self.finished[idx] = True
+			self._cond.notify_all()
+
+	def next_chunk(self):
+		"""写盘线程取队头分片的下一块；队头分片已读完时返回 None"""
+		with self._cond:
+			slot = self.slots[self.next_idx]
+			while not self.error and not slot and not self.finished[self.next_idx]:
+				self._cond.wait()
+			if self.error:
+				raise self.error
+			return slot.popleft() if slot else None
+
+	def give_back(self, buf):
+		with self._cond:
+			self.pool.give(buf)
+
+	def advance(self):
+		with self._cond:
+			self.next_idx += 1
+			self._cond.notify_all()
+
+	def reset(self, idx):
+		"""
+		分片重试前清空它的槽位，返回是否可以重来。
+		分片一旦成为队头，写盘线程可能已写出其中一部分，不能再重来。
+		"""
+		with self._cond:
+			if self.error or idx <= self.next_idx:
+				return False
+			slot = self.slots[idx]
+			while slot:
+				self.pool.give(slot.popleft()[0])
+			self._cond.notify_all()
+			return True
+
+	def abort(self, error):
+		"""中止整个视频，归还所有槽位里的缓冲区"""
+		with self._cond:
+			if not self.error:
+				self.error = error
+			for slot in self.slots:
+				while slot:
+					self.pool.give(slot.popleft()[0])
+			self._cond.notify_all()
+
+def read_stored_segment(pipeline, idx, segment, path):
+	"""从分片仓库读取，同样经过同步字节校验；校验失败时从仓库删除"""
+	verifier = SegmentVerifier(segment.url, VERIFY_SEGMENTS)
+	try:
+		with open(path, 'rb') as f:
+			for chunk in iter(lambda: f.read(pipeline.pool.chunk_size), b''):
+				verifier.feed(chunk)
+				pipeline.write(idx, chunk)
+		verifier.finish()
+	except SegmentIntegrityError:
+		segment_store.discard(segment)
+		raise
+
+def segment_retryable(error):
+	"""分片级可重试的错误：连接/超时/读中断、5xx/429、完整性校验失败；403/404 等交给视频级重试换链接"""
+	if isinstance(error, SegmentIntegrityError):
+		return True
+	if isinstance(error, requests.HTTPError):
+		status = error.response.status_code if error.response is not None else None
+		return status is None or status >= 500 or status == 429
+	return isinstance(error, requests.RequestException)
+
+# 播放列表、分片或密钥请求返回这些状态码，说明链接过期或签名失效，要丢掉缓存重新解析；
+# 5xx/429 是服务器一时出错，链接本身没问题，换链接只会多打一次签名接口
+LINK_EXPIRED_STATUS = {401, 403, 404, 410}
+
+def link_expired(error):
+	"""requests 的 HTTPError 或 aiohttp 的 ClientResponseError 是否表示链接失效"""
+	if isinstance(error, requests.HTTPError):
+		status = error.response.status_code if error.response is not None else None
+	else:
+		status = getattr(error, 'status', None)
+	return status in LINK_EXPIRED_STATUS
+
+def segment_backoff(attempt):
+	return SEGMENT_RETRY_BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+
+def fetch_segment(pipeline, idx, segment, worker=None, video=None):
+	"""
+	下载一个分片放入管道。出错时最多重试 SEGMENT_RETRIES 次：数据还没进管道时直接重来，
+	已进管道但分片还不是队头时清空槽位重来；否则(或重试用完)中止整个视频。
+	"""
+	attempt = 0
+	while True:
+		written = [False]
+		try:
+			fetch_segment_once(pipeline, idx, segment, worker, video, written)
+			return
+		except Exception as e:
+			if (attempt < SEGMENT_RETRIES and segment_retryable(e)
+					and (not written[0] or pipeline.reset(idx))):
+				attempt += 1
+				telemetry.retry('segment', video=video, idx=idx, error=str(e))
+				time.sleep(segment_backoff(attempt))
+				continue
+			pipeline.abort(e)
+			raise
+
+def fetch_segment_once(pipeline, idx, segment, worker, video, written):
+	"""下载一次；written[0] 在有数据放入管道后置为True"""
+	t0 = time.perf_counter()
+	nbytes = 0
+	tmp = None
+	try:
+		stored = segment_store.lookup(segment)
+		if stored:
+			written[0] = True
+			read_stored_segment(pipeline, idx, segment, stored)
+			pipeline.finish(idx)
+			telemetry.record('segment', time.perf_counter() - t0, worker=worker, video=video, idx=idx, stored=True)
+			return
+		decryptor = segment_decryptor(segment)
+		verifier = SegmentVerifier(segment.url, VERIFY_SEGMENTS, digest=segment_store.enabled)
+		tmp = segment_store.open_temp() if segment_store.enabled else None
+		def emit(data):
+			verifier.feed(data)
+			if data:
+				written[0] = True
+			pipeline.write(idx, data)
+			if tmp:
+				tmp[1].write(data)
+		r = http.get(segment.url, stream=True, timeout=30, headers=segment.request_headers())
+		try:
+			r.raise_for_status()
+			if segment.byterange and r.status_code != 206:
+				raise ValueError(f"服务器不支持按字节范围请求: {segment.url}")
+			for chunk in r.iter_content(chunk_size=pipeline.pool.chunk_size):
+				bandwidth.consume(len(chunk))
+				nbytes += len(chunk)
+				emit(decryptor.update(chunk) if decryptor else chunk)
+			if decryptor:
+				emit(decryptor.finalize())
+			verifier.finish(nbytes, expected_length(r.headers))
+		finally:
+			r.close()
+		if tmp:
+			tmp[1].close()
+			segment_store.commit(segment, tmp[0], verifier.hexdigest(), verifier.size)
+			tmp = None
+		pipeline.finish(idx)
+		telemetry.record('segment', time.perf_counter() - t0, nbytes, worker=worker, video=video, idx=idx)
+	except Exception as e:
+		if tmp:
+			tmp[1].close()
+			os.remove(tmp[0])
+		telemetry.record('segment', time.perf_counter() - t0, nbytes, ok=False, worker=worker, video=video, idx=idx, error=str(e))
+		raise
+
+def download_segments(segments, outf, desc=None, seg_workers=None, start=0, on_commit=None):
+	"""
+	用有界线程池并发下载分片，主线程按顺序把分片流式写入outf，内存占用受全局 buffer_pool 约束。
+	segments 是从第 start 个分片开始的剩余分片(Segment)；每个分片落盘后回调 on_commit(序号, 偏移, 长度)。
+	进度和速率记入 telemetry，desc 作为跟踪记录里的视频名。seg_workers 默认取当前的 SEGMENT_WORKERS。
+	"""
+	seg_workers = seg_workers or SEGMENT_WORKERS
+	pipeline = SegmentPipeline(len(segments))
+	# 分片线程随视频新建，速率记在发起下载的线程名下
+	worker = threading.current_thread().name
+	telemetry.expect(len(segments))
+	# 管道不支持 tell，只有需要记录偏移时才取
+	offset = outf.tell() if on_commit else 0
+	with ThreadPoolExecutor(max_workers=seg_workers) as pool:
+		futures = [pool.submit(fetch_segment, pipeline, idx, segment, worker, desc) for idx, segment in enumerate(segments)]
+		try:
+			for idx in range(len(segments)):
+				length = 0
+				while True:
+					item = pipeline.next_chunk()
+					if item is None:
+						break
+					buf, n = item
+					try:
+						outf.write(memoryview(buf)[:n])
+					finally:
+						pipeline.give_back(buf)
+					length += n
+				if on_commit:
+					# 先确保数据写入文件，再记入清单
+					outf.flush()
+					on_commit(start + idx, offset, length)
+				offset += length
+				pipeline.advance()
+		except BaseException as e:
+			pipeline.abort(e)
+			for fut in futures:
+				fut.cancel()
+			raise
+
+class SegmentManifest:
+	"""
+	分片级断点续传清单(JSON lines，与 .ts 同名加 .manifest)。
+	首行记录播放列表指纹，其后每行是一个已落盘分片的 [序号, 偏移, 长度]。
+	分片严格按顺序写入，所以已提交的分片总是从0开始的连续前缀。
+	"""
+	def __init__(self, path, ts_names):
+		self.path = path
+		self.playlist = hashlib.md5("\n".join(ts_names).encode('utf-8')).hexdigest()
+		self.committed = []
+		self._f = None
+
+	def load(self):
+		"""读取已有清单，播放列表变化或记录不连续则作废；返回已提交的分片数"""
+		self.committed = []
+		if not os.path.exists(self.path):
+			return 0
+		with open(self.path, 'r', encoding='utf-8') as f:
+			lines = f.read().splitlines()
+		try:
+			if not lines or json.loads(lines[0]).get('playlist') != self.playlist:
+				return 0
+		except ValueError:
+			return 0
+		offset = 0
+		for line in lines[1:]:
+			try:
+				idx, off, length = json.loads(line)
+			except ValueError:
+				break  # 最后一行可能在写入时被中断
+			if idx != len(self.committed) or off != offset:
+				break
+			self.committed.append((idx, off, length))
+			offset += length
+		return len(self.committed)
+
+	@property
+	def end_offset(self):
+		if not self.committed:
+			return 0
+		_, off, length = self.committed[-1]
+		return off + length
+
+	def open(self):
+		"""打开清单准备追加；没有已提交分片时重写首行"""
+		if self.committed:
+			self._f = open(self.path, 'a', encoding='utf-8')
+		else:
+			self._f = open(self.path, 'w', encoding='utf-8')
+			self._f.write(json.dumps({'playlist': self.playlist}) + "\n")
+			self._f.flush()
+
+	def commit(self, idx, offset, length):
+		self.committed.append((idx, offset, length))
+		self._f.write(json.dumps([idx, offset, length]) + "\n")
+		self._f.flush()
+
+	def close(self):
+		if self._f:
+			self._f.close()
+			self._f = None
+
+	def remove(self):
+		self.close()
+		if os.path.exists(self.path):
+			os.remove(self.path)
+
+def download_to_ts(ts_names, segments, ts_path, desc=None):
+	"""下载全部分片到 .ts，借助清单断点续传"""
+	manifest = SegmentManifest(ts_path + ".manifest", ts_names)
+	done = manifest.load()
+	# .ts 比清单记录的短说明文件被动过，只能从头下载
+	if done and (not os.path.exists(ts_path) or os.path.getsize(ts_path) < manifest.end_offset):
+		manifest.committed = []
+		done = 0
+	if done:
+		print(f"{ts_path} 断点续传：已完成 {done}/{len(segments)} 个分片")
+	manifest.open()
+	try:
+		with open(ts_path, 'r+b' if done else 'wb') as outf:
+			# 丢弃上次中断时写了一半、未记入清单的数据
+			outf.truncate(manifest.end_offset)
+			outf.seek(manifest.end_offset)
+			download_segments(segments[done:], outf, desc=desc, start=done, on_commit=manifest.commit)
+	finally:
+		manifest.close()
+	return manifest
+
+def pipe_to_ffmpeg(segments, filepath, desc=None):
+	"""分片按顺序写入 ffmpeg 标准输入，下载与转封装同时进行"""
 	import subprocess
-	target_dir = "E:\\CODE\\Test\\Targets"
-	os.makedirs(target_dir, exist_ok=True)
-	filepath = os.path.join(target_dir, filename)
-	ts_path = filepath + ".ts"
-	m3u8_baseurl = m3u8_link.rsplit('/', 1)[0] + '/'
-	m3u8_req = requests.get(m3u8_link, headers=headers, cookies=Cookies)
-	# 只保留以.ts结尾的行，忽略其它内容
-	ts_names = [line.strip() for line in m3u8_req.text.splitlines() if line.strip() and not line.startswith('#') and line.strip().endswith('.ts')]
-	ts_links = [m3u8_baseurl + name for name in ts_names]
-	with open(ts_path, 'wb') as outf:
-		for link in tqdm(ts_links,desc=filename.rsplit('\\', 1)[-1], leave=False):
-			r = requests.get(link, headers=headers, cookies=Cookies, stream=True)
-			outf.write(r.content)
-	print(f"{ts_path} 下载完成，开始转码为mp4...")
-	# ffmpeg转码
+	cmd = [
+		"ffmpeg", "-y", "-f", "mpegts", "-i", "pipe:0",
+		"-c", "copy", "-bsf:a", "aac_adtstoasc", filepath
+	]
+	proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	try:
+		download_segments(segments, proc.stdin, desc=desc)
+		proc.stdin.close()
+	except BaseException:
+		proc.kill()
+		proc.wait()
+		raise
+	if proc.wait() != 0:
+		raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+def remux_ts(ts_path, filepath, manifest=None):
+	"""ffmpeg 把 .ts 转封装为 mp4，成功后删除 .ts 和清单；返回是否成功"""
+	import subprocess
+	t0 = time.perf_counter()
 	try:
 		cmd = [
 			"ffmpeg", "-y", "-i", ts_path,
 			"-c", "copy", "-bsf:a", "aac_adtstoasc", filepath
 		]
 		subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		telemetry.record('remux', time.perf_counter() - t0, video=video_name(filepath))
 		print(f"{filepath} 转码完成！")
+		get_ledger(os.path.dirname(filepath)).add(video_name(filepath))
 		os.remove(ts_path)
+		if manifest:
+			manifest.remove()
+		return True
 	except Exception as e:
+		telemetry.record('remux', time.perf_counter() - t0, ok=False, video=video_name(filepath), error=str(e))
 		print(f"ffmpeg转码失败: {e}")
+		# 半成品mp4会被当作已下载，必须删掉；.ts 和清单保留，下一轮直接重新转码
+		if os.path.exists(filepath):
+			os.remove(filepath)
+		return False
+
+class StageStats:
+	"""流水线单个阶段的统计：排队深度、同时运行数、完成数和耗时"""
+	def __init__(self, name):
+		self.name = name
+		self.queued = 0
+		self.max_queued = 0
+		self.running = 0
+		self.done = 0
+		self.busy_time = 0.0
+		self._lock = threading.Lock()
+
+	def enqueue(self):
+		with self._lock:
+			self.queued += 1
+			self.max_queued = max(self.max_queued, self.queued)
+
+	def run(self, func, *args, **kwargs):
+		with self._lock:
+			self.queued -= 1
+			self.running += 1
+		t0 = time.perf_counter()
+		try:
+			return func(*args, **kwargs)
+		finally:
+			with self._lock:
+				self.running -= 1
+				self.done += 1
+				self.busy_time += time.perf_counter() - t0
+
+	async def arun(self, func, *args, **kwargs):
+		"""run 的协程版本，func 为协程函数"""
+		with self._lock:
+			self.queued -= 1
+			self.running += 1
+		t0 = time.perf_counter()
+		try:
+			return await func(*args, **kwargs)
+		finally:
+			with self._lock:
+				self.running -= 1
+				self.done += 1
+				self.busy_time += time.perf_counter() - t0
+
+	def summary(self):
+		avg = self.busy_time / self.done if self.done else 0.0
+		return f"{self.name}阶段：完成 {self.done}，总耗时 {self.busy_time:.1f}s，平均 {avg:.1f}s，当前排队 {self.queued}，最大排队 {self.max_queued}"
+
+class RemuxPool:
+	"""
+	独立的转封装线程池，大小默认等于CPU核数。
+	下载线程把下载完的 .ts 交给它后立即去下载下一个视频，网络与ffmpeg在整门课范围内重叠。
+	"""
+	def __init__(self, workers=None):
+		self.executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+		self.stats = StageStats("转码")
+		self._jobs = {}
+		self._lock = threading.Lock()
+
+	def submit(self, ts_path, filepath, manifest=None):
+		self.stats.enqueue()
+		fut = self.executor.submit(self.stats.run, remux_ts, ts_path, filepath, manifest)
+		with self._lock:
+			self._jobs[filepath] = fut
+		return fut
+
+	def pop_job(self, filepath):
+		"""取出某个 mp4 的转码 Future(结果为是否成功)，没有则返回 None"""
+		with self._lock:
+			return self._jobs.pop(filepath, None)
+
+	def shutdown(self):
+		self.executor.shutdown(wait=True)
+
+ATTRIBUTE_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+def parse_attributes(line):
+	"""解析 #EXT-X-...: 后面的 KEY=VALUE 属性列表"""
+	return {k: v.strip('"') for k, v in ATTRIBUTE_RE.findall(line.split(':', 1)[-1])}
+
+def select_variant(text, master_url, policy=QUALITY_POLICY, max_bitrate=MAX_BITRATE):
+	"""主播放列表按清晰度策略选一个变体，返回其媒体播放列表链接；不是主播放列表时返回 None"""
+	options = []
+	attrs = None
+	for line in text.splitlines():
+		line = line.strip()
+		if line.startswith('#EXT-X-STREAM-INF:'):
+			attrs = parse_attributes(line)
+		elif attrs is not None and line and not line.startswith('#'):
+			width, _, height = attrs.get('RESOLUTION', '').partition('x')
+			bitrate = _number(attrs.get('AVERAGE-BANDWIDTH') or attrs.get('BANDWIDTH'))
+			# 变体没有体积信息，用码率代替
+			options.append((urljoin(master_url, line), {'pixels': _number(width) * _number(height), 'bitrate': bitrate, 'size': bitrate}))
+			attrs = None
+	if not options:
+		return None
+	return choose_quality(options, policy, max_bitrate)
+
+# 主播放列表最多嵌套几层
+MAX_PLAYLIST_DEPTH = 3
+
+def fetch_playlist_text(url):
+	t0 = time.perf_counter()
+	r = http.get(url, timeout=30)
+	r.raise_for_status()
+	telemetry.record('playlist', time.perf_counter() - t0)
+	return r.text
+
+def load_playlist(m3u8_link, text=None):
+	"""读取播放列表，遇到主播放列表时按清晰度策略跟到媒体播放列表；返回 (媒体播放列表链接, 文本)"""
+	url = m3u8_link
+	if text is None:
+		text = fetch_playlist_text(url)
+	for _ in range(MAX_PLAYLIST_DEPTH):
+		variant = select_variant(text, url)
+		if variant is None:
+			return url, text
+		url = variant
+		text = fetch_playlist_text(url)
+	raise ValueError(f"主播放列表嵌套过深: {m3u8_link}")
+
+class Segment:
+	"""媒体播放列表中的一个分片：链接、字节范围(起点, 长度)、加密参数(密钥链接, IV)"""
+	__slots__ = ('url', 'byterange', 'key')
+
+	def __init__(self, url, byterange=None, key=None):
+		self.url = url
+		self.byterange = byterange
+		self.key = key
+
+	def request_headers(self):
+		if not self.byterange:
+			return None
+		start, length = self.byterange
+		return {'Range': f"bytes={start}-{start + length - 1}"}
+
+	def __repr__(self):
+		return f"Segment({self.url!r}, byterange={self.byterange})"
+
+def parse_playlist(text, m3u8_link):
+	"""
+	解析媒体播放列表，返回 (分片名列表, Segment 列表)。
+	分片名与分片仓库的键相同(链接路径加字节范围，见 SegmentStore.key)，不含查询串，
+	重新解析链接后分片签名变了，清单指纹(SegmentManifest)也不变，断点照样续传。
+	支持 #EXT-X-BYTERANGE(多个分片是同一文件的不同字节段)和 #EXT-X-KEY(AES-128 加密分片)。
+	"""
+	ts_names = []
+	segments = []
+	sequence = 0
+	key = None
+	byterange = None
+	# 省略起点的字节范围接着同一文件上一段的末尾
+	next_offset = {}
+	for line in text.splitlines():
+		line = line.strip()
+		if not line:
+			continue
+		if line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+			sequence = int(line.split(':', 1)[1])
+		elif line.startswith('#EXT-X-KEY:'):
+			attrs = parse_attributes(line)
+			method = attrs.get('METHOD', 'NONE')
+			if method == 'NONE':
+				key = None
+			elif method == 'AES-128':
+				key = (urljoin(m3u8_link, attrs['URI']), attrs.get('IV'))
+			else:
+				raise ValueError(f"不支持的加密方式: {method}")
+		elif line.startswith('#EXT-X-BYTERANGE:'):
+			length, _, offset = line.split(':', 1)[1].partition('@')
+			byterange = (int(offset) if offset else None, int(length))
+		elif not line.startswith('#'):
+			url = urljoin(m3u8_link, line)
+			if byterange:
+				offset, length = byterange
+				if offset is None:
+					offset = next_offset.get(url, 0)
+				next_offset[url] = offset + length
+				byterange = (offset, length)
+			segment_key = None
+			if key:
+				# 没有给 IV 时以媒体序号作 IV(16字节大端)
+				key_uri, iv = key
+				iv = int(iv, 16) if iv else sequence
+				segment_key = (key_uri, iv.to_bytes(16, 'big'))
+			segment = Segment(url, byterange, segment_key)
+			ts_names.append(SegmentStore.key(segment))
+			segments.append(segment)
+			byterange = None
+			sequence += 1
+	return ts_names, segments
+
+class KeyCache:
+	"""AES-128 密钥按链接缓存，同一视频的分片通常共用一把密钥"""
+	def __init__(self):
+		self._keys = {}
+		self._lock = threading.Lock()
+
+	def get(self, uri):
+		with self._lock:
+			key = self._keys.get(uri)
+		if key is None:
+			r = http.get(uri, timeout=30)
+			r.raise_for_status()
+			key = r.content
+			with self._lock:
+				self._keys[uri] = key
+		return key
+
+	async def get_async(self, session, limiter, uri, urgent=None):
+		with self._lock:
+			key = self._keys.get(uri)
+		if key is None:
+			async with limiter.slot(uri, urgent):
+				async with session.get(uri) as resp:
+					resp.raise_for_status()
+					key = await resp.read()
+			with self._lock:
+				self._keys[uri] = key
+		return key
+
+key_cache = KeyCache()
+
+class SegmentDecryptor:
+	"""AES-128-CBC 流式解密，数据块边下边解，最后去掉 PKCS7 填充。需要安装 cryptography。"""
+	def __init__(self, key, iv):
+		from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+		from cryptography.hazmat.primitives import padding
+		self._decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+		self._unpadder = padding.PKCS7(128).unpadder()
+
+	def update(self, data):
+		return self._unpadder.update(self._decryptor.update(data))
+
+	def finalize(self):
+		return self._unpadder.update(self._decryptor.finalize()) + self._unpadder.finalize()
+
+def segment_decryptor(segment):
+	"""分片未加密时返回 None"""
+	if not segment.key:
+		return None
+	key_uri, iv = segment.key
+	return SegmentDecryptor(key_cache.get(key_uri), iv)
+
+class PlaylistCache:
+	"""
+	调度阶段读到的媒体播放列表，按原始链接缓存，下载时取出复用(只用一次)。
+	文本和链接一起过期(link_expiry)，过期的不再返回；一批下载结束时清空，跳过或失败的视频不会留下条目。
+	"""
+	def __init__(self):
+		self._entries = {}
+		self._lock = threading.Lock()
+
+	def put(self, link, media_url, text):
+		with self._lock:
+			self._entries[link] = (media_url, text, link_expiry(link))
+
+	def pop(self, link):
+		"""返回 (媒体播放列表链接, 文本)；没有或已过期时返回 None"""
+		with self._lock:
+			entry = self._entries.pop(link, None)
+		if entry and entry[2] > time.time():
+			return entry[:2]
+		return None
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+
+playlist_cache = PlaylistCache()
+
+def playlist_duration(text):
+	"""m3u8 总时长(秒)；没有 #EXTINF 时退化为分片数"""
+	total = 0.0
+	count = 0
+	for line in text.splitlines():
+		line = line.strip()
+		if line.startswith('#EXTINF:'):
+			try:
+				total += float(line[len('#EXTINF:'):].split(',', 1)[0])
+			except ValueError:
+				pass
+		elif line and not line.startswith('#'):
+			count += 1
+	return total or float(count)
+
+def probe_units(units, max_workers=5):
+	"""并发解析链接并读取 m3u8，返回 {contentId: 时长}；已完成或读取失败的记为 0"""
+	def probe(unit):
+		if unit.name in get_ledger(unit.target_dir):
+			return 0.0
+		link = link_cache.resolve(unit)
+		if not link:
+			return 0.0
+		media_url, text = load_playlist(link)
+		playlist_cache.put(link, media_url, text)
+		return playlist_duration(text)
+	durations = {}
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		futures = {executor.submit(probe, unit): unit for unit in units}
+		for future in as_completed(futures):
+			unit = futures[future]
+			try:
+				durations[unit.content_id] = future.result()
+			except Exception as e:
+				print(f"{unit.name} 读取时长失败: {e}")
+				durations[unit.content_id] = 0.0
+	return durations
+
+def schedule_units(units, order=SCHEDULE_ORDER, chapter_priority=None, durations=None):
+	"""
+	排出下载顺序。chapter_priority 为 {章序号: 优先级}，数值大的章先下载(默认 0)；
+	同一优先级内 order='longest' 按时长从长到短(最长处理时间优先，缩短整体完成时间)，'course' 保持课程顺序。
+	"""
+	priority = chapter_priority or {}
+	durations = durations or {}
+	if order == 'longest':
+		return sorted(units, key=lambda u: (-priority.get(u.chapter_idx, 0), -durations.get(u.content_id, 0.0)))
+	return sorted(units, key=lambda u: -priority.get(u.chapter_idx, 0))
+
+def m3u8_2_mp4(m3u8_link, filename, pipe=PIPE_TO_FFMPEG, remux_pool=None):
+	"""
+	下载并转为mp4。传入 remux_pool 时只负责下载，转码交给转码池后立即返回。
+	"""
+	# filename 可以是完整路径(各课程自己的目录)，也可以只是文件名
+	filepath = filename if os.path.dirname(filename) else os.path.join(TARGET_DIR, filename)
+	os.makedirs(os.path.dirname(filepath), exist_ok=True)
+	ts_path = filepath + ".ts"
+	desc = filename.rsplit('\\', 1)[-1]
+	# 调度阶段已读过的播放列表直接复用
+	cached = playlist_cache.pop(m3u8_link)
+	media_url, text = cached if cached else load_playlist(m3u8_link)
+	ts_names, segments = parse_playlist(text, media_url)
+	# 已有未完成的 .ts 时优先续传，不走管道
+	if pipe and not os.path.exists(ts_path):
+		try:
+			pipe_to_ffmpeg(segments, filepath, desc=desc)
+			get_ledger(os.path.dirname(filepath)).add(video_name(filepath))
+			print(f"{filepath} 边下边转完成！")
+			return
+		except Exception as e:
+			print(f"管道转码失败: {e}，改为先下载再转码")
+			if os.path.exists(filepath):
+				os.remove(filepath)
+	manifest = download_to_ts(ts_names, segments, ts_path, desc=desc)
+	if remux_pool:
+		print(f"{ts_path} 下载完成，已加入转码队列")
+		remux_pool.submit(ts_path, filepath, manifest)
+	else:
+		print(f"{ts_path} 下载完成，开始转码为mp4...")
+		remux_ts(ts_path, filepath, manifest)
 
-def check_downloaded():
+def check_downloaded(target_dir=TARGET_DIR):
 	"""
 	Check the Target directory for downloaded .mp4 files and return their filenames in a set (不含扩展名)。
 	"""
-	target_dir = r"E:\\CODE\\Test\\Targets"
 	if not os.path.exists(target_dir):
 		return set()
 	downloaded_files = {file.rsplit('.mp4', 1)[0] for file in os.listdir(target_dir) if file.endswith('.mp4')}
 	return downloaded_files
 
-def download_one(videoid, name, max_retry=3):
-	target_dir = r"E:\\CODE\\Test\\Targets"
+def video_name(filepath):
+	"""mp4 路径 -> 不含扩展名的文件名，与 check_downloaded 的结果一致"""
+	return filepath.replace('\\', '/').rsplit('/', 1)[-1].rsplit('.mp4', 1)[0]
+
+class CompletionLedger:
+	"""
+	已完成视频的持久索引，是"是否已下载"的唯一依据，避免每次尝试都 os.listdir 整个目录。
+	存为目标目录下的 JSON lines 文件，每完成一个视频追加一行；首次使用时若文件不存在则扫描目录重建。
+	"""
+	def __init__(self, target_dir=TARGET_DIR, filename=".completed.jsonl"):
+		self.target_dir = target_dir
+		self.path = os.path.join(target_dir, filename)
+		self._names = None
+		self._lock = threading.Lock()
+
+	def _load(self):
+		# 须持有 _lock 调用
+		if self._names is not None:
+			return
+		if not os.path.exists(self.path):
+			self._rebuild()
+			return
+		names = set()
+		with open(self.path, 'r', encoding='utf-8') as f:
+			for line in f:
+				try:
+					names.add(json.loads(line)['name'])
+				except (ValueError, KeyError, TypeError):
+					continue  # 写入时被中断的残行
+		self._names = names
+
+	def _rebuild(self):
+		# 先写临时文件再整体替换，重建过程中崩溃不会留下半个索引
+		self._names = check_downloaded(self.target_dir)
+		os.makedirs(self.target_dir, exist_ok=True)
+		tmp_path = self.path + ".tmp"
+		with open(tmp_path, 'w', encoding='utf-8') as f:
+			for name in sorted(self._names):
+				f.write(json.dumps({'name': name}, ensure_ascii=False) + "\n")
+		os.replace(tmp_path, self.path)
+
+	def rebuild(self):
+		"""按目录中现有的 .mp4 重建索引"""
+		with self._lock:
+			self._rebuild()
+
+	def add(self, name):
+		with self._lock:
+			self._load()
+			if name in self._names:
+				return
+			# 单行追加后立即 flush，崩溃时最多丢失最后一条
+			with open(self.path, 'a', encoding='utf-8') as f:
+				f.write(json.dumps({'name': name}, ensure_ascii=False) + "\n")
+			self._names.add(name)
+
+	def __contains__(self, name):
+		with self._lock:
+			self._load()
+			return name in self._names
+
+	def names(self):
+		with self._lock:
+			self._load()
+			return set(self._names)
+
+_ledgers = {}
+_ledgers_lock = threading.Lock()
+
+def get_ledger(target_dir=TARGET_DIR):
+	"""每个输出目录一个完成索引，多课程时同名视频互不干扰"""
+	key = os.path.normcase(os.path.normpath(target_dir))
+	with _ledgers_lock:
+		if key not in _ledgers:
+			_ledgers[key] = CompletionLedger(target_dir)
+		return _ledgers[key]
+
+completed = get_ledger(TARGET_DIR)
+
+def download_one(unit, max_retry=3, pipe=PIPE_TO_FFMPEG, remux_pool=None, prefetcher=None):
+	name = unit.name
+	filepath = unit.filepath
+	ledger = get_ledger(unit.target_dir)
+	if prefetcher:
+		prefetcher.started(unit)
 	for attempt in range(max_retry):
 		try:
-			downloaded = check_downloaded()
-			if name in downloaded:
+			if name in ledger:
 				return 'exists'  # 不打印，交由外部统计
-			signature = get_signature(bizids[videoids.index(videoid)], csrfkey)
-			m3u8_link = get_video_link(videoid, signature)
+			# 链接通常已被预取；RPC 已在 call_rpc 内按请求退避重试，这里不再固定等待
+			m3u8_link = link_cache.resolve(unit)
 			if m3u8_link:
 				print(f"正在下载: {name}.mp4")
-				m3u8_2_mp4(m3u8_link, f"{target_dir}\\{name}.mp4")
+				m3u8_2_mp4(m3u8_link, filepath, pipe=pipe, remux_pool=remux_pool)
 				return 'success'
-			else:
-				time.sleep(2)
 		except Exception as e:
+			if link_expired(e):
+				link_cache.invalidate(unit)
 			print(f"{name} 下载出错: {e}，重试({attempt+1}/{max_retry})")
-			time.sleep(2)
+			# 最后一次失败后直接返回，不再等待
+			if attempt + 1 < max_retry:
+				telemetry.retry('video', video=name)
+				time.sleep(backoff_delay(attempt))
 	# 删除失败的文件（如果存在）
-	filepath = os.path.join(target_dir, f"{name}.mp4")
 	if os.path.exists(filepath):
 		os.remove(filepath)
 	return 'fail'
 
-def batch_download_with_retry(videoids, names, max_workers=5, max_retry=3):
-	to_download = list(zip(videoids, names))
+def batch_download_with_retry(units, max_workers=5, max_retry=3, chunk_size=CHUNK_SIZE, memory_budget=MEMORY_BUDGET, pipe_to_ffmpeg=PIPE_TO_FFMPEG, remux_workers=None, engine=ENGINE, prefetch_ahead=PREFETCH_AHEAD, order=SCHEDULE_ORDER, chapter_priority=None, max_bandwidth=MAX_BANDWIDTH, trace_file=TRACE_FILE, live_view=LIVE_VIEW, segment_store_dir=SEGMENT_STORE):
+	"""
+	engine='thread' 为线程池引擎；engine='async' 改用 asyncio 引擎(见 async_batch_download)，便于对比。
+	prefetch_ahead 为后台预取链接领先的视频数，0 表示不预取。
+	order / chapter_priority 决定下载顺序，见 schedule_units；max_bandwidth 为全局带宽上限(字节/秒)。
+	所有视频放进一个连续的工作队列，失败的视频立即重新排队(每个最多 max_retry 次)，不再按轮次等待。
+	trace_file 为遥测跟踪文件(JSON lines)；live_view 为True时显示汇总进度，结束时打印各阶段耗时分布。
+	segment_store_dir 为内容寻址分片仓库目录，见 SegmentStore。
+	"""
+	bandwidth.configure(max_bandwidth)
+	segment_store.configure(segment_store_dir)
+	live = start_telemetry(trace_file, live_view)
+	durations = probe_units(units, max_workers) if order == 'longest' else None
+	units = schedule_units(units, order, chapter_priority, durations)
+	if engine == 'async':
+		import asyncio
+		try:
+			return asyncio.run(async_batch_download(units, max_workers=max_workers, max_retry=max_retry, seg_workers=SEGMENT_WORKERS, remux_workers=remux_workers, memory_budget=memory_budget, chunk_size=chunk_size))
+		finally:
+			playlist_cache.clear()
+			stop_telemetry(live)
+			if segment_store.enabled:
+				print(segment_store.summary())
+	http.resize(max_workers)
+	buffer_pool.configure(memory_budget, chunk_size)
+	# 管道模式下转码和下载本来就在同一线程里重叠，不需要单独的转码池
+	remux_pool = None if pipe_to_ffmpeg else RemuxPool(remux_workers)
+	download_stats = StageStats("下载")
 	all_exists = set()
 	all_success = set()
-	for round_num in range(max_retry):
-		print(f"第{round_num+1}轮下载，待下载数量：{len(to_download)}")
-		failed = []
-		with ThreadPoolExecutor(max_workers=max_workers) as executor:
-			futures = {executor.submit(download_one, vid, name, 1): (vid, name) for vid, name in to_download}
-			for future in as_completed(futures):
-				vid, name = futures[future]
+	failed = []
+	attempts = {}
+	print(f"待下载数量：{len(units)}")
+	prefetcher = None
+	if prefetch_ahead:
+		# 前 max_workers 个视频会被下载线程立刻取走，预取从其后开始领先
+		prefetcher = LinkPrefetcher(units[max_workers:], lookahead=prefetch_ahead)
+		prefetcher.start()
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		pending = {}
+		def submit(unit):
+			attempts[unit.content_id] = attempts.get(unit.content_id, 0) + 1
+			download_stats.enqueue()
+			pending[executor.submit(download_stats.run, download_one, unit, 1, pipe_to_ffmpeg, remux_pool, prefetcher)] = ('download', unit)
+		for unit in units:
+			submit(unit)
+		while pending:
+			done, _ = wait(pending, return_when=FIRST_COMPLETED)
+			for future in done:
+				stage, unit = pending.pop(future)
 				result = future.result()
-				if result == 'exists':
-					all_exists.add(name)
-				elif result == 'success':
-					all_success.add(name)
+				if stage == 'download' and result == 'exists':
+					all_exists.add(unit.name)
+					continue
+				if stage == 'download' and result == 'success':
+					remux_future = remux_pool.pop_job(unit.filepath) if remux_pool else None
+					if remux_future:
+						pending[remux_future] = ('remux', unit)
+					else:
+						all_success.add(unit.name)
+					continue
+				if stage == 'remux' and result:
+					all_success.add(unit.name)
+					continue
+				# 下载或转码失败：还有次数就立即重新排队
+				if unit.name in get_ledger(unit.target_dir):
+					all_success.add(unit.name)
+				elif attempts[unit.content_id] < max_retry:
+					print(f"{unit.name} 失败，重新排队({attempts[unit.content_id]}/{max_retry})")
+					telemetry.retry('video', video=unit.name)
+					submit(unit)
 				else:
-					failed.append((vid, name))
-		# 关键：每轮后刷新已下载
-		downloaded = check_downloaded()
-		to_download = [(vid, name) for vid, name in failed if name not in downloaded]
-		if not to_download:
-			break
+					failed.append(unit)
+	if prefetcher:
+		prefetcher.stop()
+	if remux_pool:
+		remux_pool.shutdown()
+	playlist_cache.clear()
+	stop_telemetry(live)
 	# 统一打印统计
 	if all_exists:
 		print(f"已存在（跳过）: {sorted(all_exists)}")
 	if all_success:
 		print(f"本次成功下载: {sorted(all_success)}")
-	if to_download:
-		print("以下视频多次重试仍失败：", [name for _, name in to_download])
+	if failed:
+		print("以下视频多次重试仍失败：", [unit.name for unit in failed])
+	if remux_pool:
+		print(remux_pool.stats.summary())
+	print(download_stats.summary())
+	conn = http.stats()
+	print(f"连接统计：新建 {conn['opened']}，复用 {conn['reused']}")
+	if segment_store.enabled:
+		print(segment_store.summary())
+
+# --- 多课程批量模式 ---
+def safe_dirname(name):
+	"""去掉 Windows 目录名中的非法字符"""
+	return re.sub(r'[\\/*?:"<>|\n\r\t]', "", name).strip() or "未命名课程"
+
+def load_term_units(tid, referer=None, target_dir=None):
+	"""获取一个学期的章节树并生成 VideoUnit；target_dir 默认为 TARGET_DIR 下以课程名命名的子目录"""
+	term_json = term_avail(get_csrfkey(), tid, referer)
+	term_dto = term_json["result"]["mocTermDto"]
+	if target_dir is None:
+		course_name = term_dto.get("courseName") or str(tid)
+		target_dir = os.path.join(TARGET_DIR, safe_dirname(course_name))
+	return get_video_units(term_dto["chapters"], term_id=tid, target_dir=target_dir)
+
+def batch_download_terms(terms, max_workers=5, max_bandwidth=MAX_BANDWIDTH, **kwargs):
+	"""
+	多门课程一次下载。terms 为学期ID列表，或 {学期ID: 课程页Referer} 字典。
+	所有学期的视频合并成一个队列，共用同一组下载线程、连接池、内存和带宽预算，每门课输出到自己的目录。
+	其余参数原样传给 batch_download_with_retry。
+	"""
+	if not isinstance(terms, dict):
+		terms = {tid: None for tid in terms}
+	term_units = {}
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		futures = {executor.submit(load_term_units, tid, referer): tid for tid, referer in terms.items()}
+		for future in as_completed(futures):
+			tid = futures[future]
+			try:
+				term_units[tid] = future.result()
+			except Exception as e:
+				print(f"学期 {tid} 课程信息获取失败: {e}")
+	all_units = []
+	for tid in terms:
+		units_of_term = term_units.get(tid, [])
+		if units_of_term:
+			print(f"学期 {tid}：{len(units_of_term)} 个视频 -> {units_of_term[0].target_dir}")
+		all_units.extend(units_of_term)
+	return batch_download_with_retry(all_units, max_workers=max_workers, max_bandwidth=max_bandwidth, **kwargs)
+
+# --- asyncio 引擎 ---
+# asyncio 会连带导入 subprocess 等模块，只在用到它的函数里导入，线程引擎和作为库导入时不加载
+# 每个主机(含端口)同时进行的请求数上限，未列出的主机(分片CDN)使用 default
+HOST_LIMITS = {
+	urlsplit(ICOURSE_BASE).netloc: 8,
+	urlsplit(VOD_BASE).netloc: 8,
+	"default": 64,
+}
+
+class HostLimiter:
+	"""
+	限制对每个主机的并发请求数，用法 async with limiter(url)。
+	所有等待共用 cond；asyncio 引擎传入 AsyncBufferPool 的 cond，分片在排队期间成为队头时 advance 也能唤醒它。
+	"""
+	def __init__(self, limits=None, cond=None):
+		import asyncio
+		self.limits = dict(HOST_LIMITS, **(limits or {}))
+		self.cond = cond or asyncio.Condition()
+		self.used = {}
+
+	@asynccontextmanager
+	async def slot(self, url, urgent=None):
+		"""
+		占用 url 所在主机的一个名额。urgent() 为真时不排队，可能超出上限：
+		视频的队头分片要用它，否则名额被等内存预算的后续分片占满，而预算只有队头写盘后才会释放。
+		"""
+		host = urlsplit(url).netloc
+		limit = self.limits.get(host, self.limits['default'])
+		async with self.cond:
+			while self.used.get(host, 0) >= limit and not (urgent and urgent()):
+				await self.cond.wait()
+			self.used[host] = self.used.get(host, 0) + 1
+		try:
+			yield
+		finally:
+			async with self.cond:
+				self.used[host] -= 1
+				self.cond.notify_all()
+
+	def __call__(self, url):
+		return self.slot(url)
+
+async def call_rpc_async(endpoint, session, limiter, method, url, max_attempts=RPC_MAX_ATTEMPTS, **kwargs):
+	"""call_rpc 的协程版本；kwargs 为可调用对象时每次重试重新求值(用于带时间戳的签名参数)"""
+	import asyncio
+	import aiohttp
+	rate_limiter = rate_limiters[endpoint]
+	for attempt in range(max_attempts):
+		await rate_limiter.acquire_async()
+		t0 = time.perf_counter()
+		try:
+			request_kwargs = {k: v() if callable(v) else v for k, v in kwargs.items()}
+			async with limiter(url):
+				async with session.request(method, url, **request_kwargs) as resp:
+					resp_json = check_rpc_response(resp.status, json.loads(await resp.text()))
+		except (RpcError, aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+			telemetry.record(endpoint, time.perf_counter() - t0, ok=False, error=str(e))
+			rate_limiter.on_error()
+			if attempt + 1 < max_attempts:
+				telemetry.retry(endpoint)
+				await asyncio.sleep(backoff_delay(attempt))
+			else:
+				print(f"{endpoint} 请求失败: {e}")
+			continue
+		telemetry.record(endpoint, time.perf_counter() - t0)
+		rate_limiter.on_success()
+		return resp_json
+	return None
+
+async def get_signature_async(session, limiter, bizid, csrfkey):
+	url = f"{ICOURSE_BASE}/web/j/resourceRpcBean.getResourceTokenV2.rpc?csrfKey={csrfkey}"
+	resp_json = await call_rpc_async('signature', session, limiter, 'POST', url, data=lambda: signature_params(bizid))
+	if resp_json:
+		return resp_json['result']['videoSignDto']['signature']
+	return None
+
+async def get_video_link_async(session, limiter, videoid, signature):
+	params = {"videoId": videoid, "signature": signature, "clientType": 1}
+	resp_json = await call_rpc_async('video_link', session, limiter, 'GET', VIDEO_API, params=params)
+	if resp_json:
+		return select_video(resp_json['result']['videos'])
+	print("链接获取失败!")
+	return None
+
+async def fetch_text_async(session, limiter, url):
+	async with limiter(url):
+		t0 = time.perf_counter()
+		async with session.get(url) as resp:
+			resp.raise_for_status()
+			text = await resp.text()
+		telemetry.record('playlist', time.perf_counter() - t0)
+		return text
+
+async def load_playlist_async(session, limiter, m3u8_link):
+	"""load_playlist 的协程版本"""
+	url = m3u8_link
+	text = await fetch_text_async(session, limiter, url)
+	for _ in range(MAX_PLAYLIST_DEPTH):
+		variant = select_variant(text, url)
+		if variant is None:
+			return url, text
+		url = variant
+		text = await fetch_text_async(session, limiter, url)
+	raise ValueError(f"主播放列表嵌套过深: {m3u8_link}")
+
+class AsyncBufferPool(BufferPool):
+	"""
+	BufferPool 的协程版本，asyncio 引擎里所有视频共用同一份预算。
+	账目沿用 BufferPool，协程都在同一个事件循环里，只把等待换成 asyncio.Condition。
+	"""
+	def __init__(self, budget=MEMORY_BUDGET, chunk_size=CHUNK_SIZE):
+		import asyncio
+		super().__init__(budget, chunk_size)
+		self.cond = asyncio.Condition()
+
+class AsyncSegmentPipeline:
+	"""SegmentPipeline 的协程版本：分片协程把数据块放进槽位，写盘协程只消费队头槽位"""
+	def __init__(self, count, pool):
+		self.pool = pool
+		self._cond = pool.cond
+		self.slots = [deque() for _ in range(count)]
+		self.finished = [False] * count
+		self.next_idx = 0
+		self.error = None
+		self.running = 0
+
+	def is_head(self, idx):
+		return idx == self.next_idx
+
+	async def start(self, idx, workers):
+		"""
+		等到分片 idx 可以开始下载：同时下载的分片不超过 workers 个，领先队头不超过 workers * 2 个。
+		队头分片总是放行，和 take_buffer 里队头可临时超出预算是同一个道理。
+		"""
+		async with self._cond:
+			while not self.error and idx != self.next_idx and (self.running >= workers or idx >= self.next_idx + workers * 2):
+				await self._cond.wait()
+			if self.error:
+				raise RuntimeError("分片下载已中止")
+			self.running += 1
+
+	async def stop(self):
+		async with self._cond:
+			self.running -= 1
+			self._cond.notify_all()
+
+	async def take_buffer(self, idx):
+		async with self._cond:
+			while True:
+				if self.error:
+					raise RuntimeError("分片下载已中止")
+				urgent = idx == self.next_idx and len(self.slots[idx]) < 2
+				buf = self.pool.try_take(urgent)
+				if buf is not None:
+					return buf
+				await self._cond.wait()
+
+	async def write(self, idx, data):
+		view = memoryview(data)
+		while view:
+			buf = await self.take_buffer(idx)
+			n = min(len(buf), len(view))
+			buf[:n] = view[:n]
+			async with self._cond:
+				if self.error:
+					self.pool.give(buf)
+					raise RuntimeError("分片下载已中止")
+				self.slots[idx].append((buf, n))
+				self._cond.notify_all()
+			view = view[n:]
+
+	async def finish(self, idx):
+		async with self._cond:
+			self.finished[idx] = True
+			self._cond.notify_all()
+
+	async def next_chunk(self):
+		async with self._cond:
+			slot = self.slots[self.next_idx]
+			while not self.error and not slot and not self.finished[self.next_idx]:
+				await self._cond.wait()
+			if self.error:
+				raise self.error
+			return slot.popleft() if slot else None
+
+	async def give_back(self, buf):
+		async with self._cond:
+			self.pool.give(buf)
+
+	async def advance(self):
+		async with self._cond:
+			self.next_idx += 1
+			self._cond.notify_all()
+
+	async def reset(self, idx):
+		async with self._cond:
+			if self.error or idx <= self.next_idx:
+				return False
+			slot = self.slots[idx]
+			while slot:
+				self.pool.give(slot.popleft()[0])
+			self._cond.notify_all()
+			return True
+
+	async def abort(self, error):
+		async with self._cond:
+			if not self.error:
+				self.error = error
+			for slot in self.slots:
+				while slot:
+					self.pool.give(slot.popleft()[0])
+			self._cond.notify_all()
+
+def segment_retryable_async(error):
+	"""segment_retryable 的 aiohttp 版本"""
+	import asyncio
+	import aiohttp
+	if isinstance(error, SegmentIntegrityError):
+		return True
+	if isinstance(error, aiohttp.ClientResponseError):
+		return error.status >= 500 or error.status == 429
+	return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+async def fetch_segment_async(session, limiter, pipeline, idx, segment, seg_workers, video=None):
+	"""
+	fetch_segment 的协程版本，重试规则相同。
+	重试期间一直占着 pipeline.start 的名额，免得重试的分片排到后面的分片之后。
+	"""
+	import asyncio
+	try:
+		await pipeline.start(idx, seg_workers)
+	except RuntimeError:
+		return  # 视频已中止，错误由出错的分片报告
+	try:
+		attempt = 0
+		while True:
+			written = [False]
+			try:
+				await fetch_segment_once_async(session, limiter, pipeline, idx, segment, video, written)
+				return
+			except Exception as e:
+				if (attempt < SEGMENT_RETRIES and segment_retryable_async(e)
+						and (not written[0] or await pipeline.reset(idx))):
+					attempt += 1
+					telemetry.retry('segment', video=video, idx=idx, error=str(e))
+					await asyncio.sleep(segment_backoff(attempt))
+					continue
+				await pipeline.abort(e)
+				raise
+	finally:
+		await pipeline.stop()
+
+async def fetch_segment_once_async(session, limiter, pipeline, idx, segment, video, written):
+	"""用 iter_chunked 边收边放进管道，数据块大小与缓冲区一致"""
+	t0 = time.perf_counter()
+	nbytes = 0
+	tmp = None
+	try:
+		stored = segment_store.lookup(segment)
+		if stored:
+			written[0] = True
+			verifier = SegmentVerifier(segment.url, VERIFY_SEGMENTS)
+			try:
+				with open(stored, 'rb') as f:
+					for chunk in iter(lambda: f.read(pipeline.pool.chunk_size), b''):
+						verifier.feed(chunk)
+						await pipeline.write(idx, chunk)
+				verifier.finish()
+			except SegmentIntegrityError:
+				segment_store.discard(segment)
+				raise
+			await pipeline.finish(idx)
+			telemetry.record('segment', time.perf_counter() - t0, worker=video, video=video, idx=idx, stored=True)
+			return
+		urgent = lambda: pipeline.is_head(idx)
+		key = await key_cache.get_async(session, limiter, segment.key[0], urgent) if segment.key else None
+		decryptor = SegmentDecryptor(key, segment.key[1]) if key else None
+		verifier = SegmentVerifier(segment.url, VERIFY_SEGMENTS, digest=segment_store.enabled)
+		tmp = segment_store.open_temp() if segment_store.enabled else None
+		async def emit(data):
+			verifier.feed(data)
+			if data:
+				written[0] = True
+			await pipeline.write(idx, data)
+			if tmp:
+				tmp[1].write(data)
+		async with limiter.slot(segment.url, urgent):
+			t0 = time.perf_counter()
+			async with session.get(segment.url, headers=segment.request_headers()) as resp:
+				resp.raise_for_status()
+				if segment.byterange and resp.status != 206:
+					raise ValueError(f"服务器不支持按字节范围请求: {segment.url}")
+				async for chunk in resp.content.iter_chunked(pipeline.pool.chunk_size):
+					await bandwidth.consume_async(len(chunk))
+					nbytes += len(chunk)
+					await emit(decryptor.update(chunk) if decryptor else chunk)
+				if decryptor:
+					await emit(decryptor.finalize())
+				verifier.finish(nbytes, expected_length(resp.headers))
+		if tmp:
+			tmp[1].close()
+			segment_store.commit(segment, tmp[0], verifier.hexdigest(), verifier.size)
+			tmp = None
+		await pipeline.finish(idx)
+		telemetry.record('segment', time.perf_counter() - t0, nbytes, worker=video, video=video, idx=idx)
+	except Exception as e:
+		if tmp:
+			tmp[1].close()
+			os.remove(tmp[0])
+		telemetry.record('segment', time.perf_counter() - t0, nbytes, ok=False, worker=video, video=video, idx=idx, error=str(e))
+		raise
+
+async def download_to_ts_async(session, limiter, pool, ts_names, segments, ts_path, seg_workers=SEGMENT_WORKERS, desc=None):
+	"""
+	与 download_to_ts 相同的清单续传，分片用协程并发下载、按顺序流式写盘。
+	同一视频最多 seg_workers 个分片同时在下载、领先写盘位置不超过 seg_workers * 2 个(见 AsyncSegmentPipeline.start)，
+	已下载未写盘的数据受 pool(AsyncBufferPool)的全局预算约束。
+	"""
+	import asyncio
+	manifest = SegmentManifest(ts_path + ".manifest", ts_names)
+	done = manifest.load()
+	if done and (not os.path.exists(ts_path) or os.path.getsize(ts_path) < manifest.end_offset):
+		manifest.committed = []
+		done = 0
+	pipeline = AsyncSegmentPipeline(len(segments) - done, pool)
+	telemetry.expect(len(segments) - done)
+	manifest.open()
+	tasks = [asyncio.ensure_future(fetch_segment_async(session, limiter, pipeline, idx, segment, seg_workers, desc))
+		for idx, segment in enumerate(segments[done:])]
+	try:
+		with open(ts_path, 'r+b' if done else 'wb') as outf:
+			outf.truncate(manifest.end_offset)
+			outf.seek(manifest.end_offset)
+			offset = manifest.end_offset
+			for idx in range(len(tasks)):
+				length = 0
+				while True:
+					item = await pipeline.next_chunk()
+					if item is None:
+						break
+					buf, n = item
+					try:
+						outf.write(memoryview(buf)[:n])
+					finally:
+						await pipeline.give_back(buf)
+					length += n
+				outf.flush()
+				manifest.commit(done + idx, offset, length)
+				offset += length
+				await pipeline.advance()
+	except BaseException as e:
+		await pipeline.abort(e)
+		raise
+	finally:
+		for task in tasks:
+			task.cancel()
+		await asyncio.gather(*tasks, return_exceptions=True)
+		manifest.close()
+	return manifest
+
+async def download_one_async(session, limiter, pool, unit, remux_pool, seg_workers=SEGMENT_WORKERS, max_retry=3):
+	import asyncio
+	filepath = unit.filepath
+	ts_path = filepath + ".ts"
+	os.makedirs(unit.target_dir, exist_ok=True)
+	for attempt in range(max_retry):
+		try:
+			if unit.name in get_ledger(unit.target_dir):
+				return 'exists'
+			m3u8_link = link_cache.cached_link(unit)
+			if not m3u8_link:
+				signature = await get_signature_async(session, limiter, unit.bizid, get_csrfkey())
+				m3u8_link = await get_video_link_async(session, limiter, unit.content_id, signature) if signature else None
+				link_cache.store(unit, signature, m3u8_link)
+			if not m3u8_link:
+				continue
+			print(f"正在下载: {unit.name}.mp4")
+			cached = playlist_cache.pop(m3u8_link)
+			media_url, text = cached if cached else await load_playlist_async(session, limiter, m3u8_link)
+			ts_names, segments = parse_playlist(text, media_url)
+			manifest = await download_to_ts_async(session, limiter, pool, ts_names, segments, ts_path, seg_workers, desc=f"{unit.name}.mp4")
+			remux_pool.submit(ts_path, filepath, manifest)
+			print(f"{ts_path} 下载完成，已加入转码队列")
+			return 'success'
+		except Exception as e:
+			if link_expired(e):
+				link_cache.invalidate(unit)
+			print(f"{unit.name} 下载出错: {e}，重试({attempt+1}/{max_retry})")
+			if attempt + 1 < max_retry:
+				telemetry.retry('video', video=unit.name)
+				await asyncio.sleep(backoff_delay(attempt))
+	return 'fail'
+
+async def async_batch_download(units, max_workers=5, max_retry=3, seg_workers=SEGMENT_WORKERS, host_limits=None, remux_workers=None, memory_budget=MEMORY_BUDGET, chunk_size=CHUNK_SIZE):
+	"""
+	asyncio 引擎：签名 -> 视频链接 -> m3u8 -> 分片 全程协程化，分片并发不再受线程数限制。
+	同时下载的视频数为 max_workers，每个视频的分片并发为 seg_workers，每个主机的并发见 HOST_LIMITS。
+	与线程引擎一样，所有视频已下载未写盘的数据合计不超过 memory_budget。
+	转码仍交给 RemuxPool。需要安装 aiohttp；不支持管道模式。
+	"""
+	import asyncio
+	import aiohttp
+	pool = AsyncBufferPool(memory_budget, chunk_size)
+	# 主机名额和内存预算共用一个条件变量，见 HostLimiter.slot
+	limiter = HostLimiter(host_limits, pool.cond)
+	unit_sem = asyncio.Semaphore(max_workers)
+	remux_pool = RemuxPool(remux_workers)
+	download_stats = StageStats("下载")
+	results = {'exists': [], 'success': [], 'fail': []}
+
+	async def worker(unit):
+		for attempt in range(max_retry):
+			download_stats.enqueue()
+			async with unit_sem:
+				result = await download_stats.arun(download_one_async, session, limiter, pool, unit, remux_pool, seg_workers, max_retry)
+			remux_future = remux_pool.pop_job(unit.filepath) if result == 'success' else None
+			# 转码在 unit_sem 之外等待，下载名额已经让给下一个视频
+			if remux_future is None or await asyncio.wrap_future(remux_future):
+				break
+			# 转码失败：.ts 和清单还在，和线程引擎一样重新排队
+			result = 'fail'
+			if attempt + 1 < max_retry:
+				print(f"{unit.name} 转码失败，重新排队({attempt+1}/{max_retry})")
+				telemetry.retry('video', video=unit.name)
+		results[result].append(unit.name)
+
+	# 连接数由 HostLimiter 控制，连接器本身不再限制
+	connector = aiohttp.TCPConnector(limit=0)
+	timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=30)
+	try:
+		async with aiohttp.ClientSession(headers=headers, cookies=get_cookies(), connector=connector, timeout=timeout) as session:
+			await asyncio.gather(*(worker(unit) for unit in units))
+	finally:
+		remux_pool.shutdown()
+	if results['exists']:
+		print(f"已存在（跳过）: {sorted(results['exists'])}")
+	if results['success']:
+		print(f"本次成功下载: {sorted(results['success'])}")
+	if results['fail']:
+		print("以下视频多次重试仍失败：", results['fail'])
+	print(remux_pool.stats.summary())
+	print(download_stats.summary())
+	return results
+
+# --- 命令行入口 ---
+def main(argv=None):
+	"""
+	用法：python test.py [学期ID ...] [--workers 5] [--retry 3] [--engine thread|async] [--max-bandwidth 字节/秒]
+	不给学期ID时下载默认学期 tid 到 TARGET_DIR；给多个时按多课程模式各自输出到课程名子目录。
+	作为库使用时直接调用 load_units / batch_download_with_retry / batch_download_terms。
+	"""
+	import argparse
+	parser = argparse.ArgumentParser(description="下载中国大学MOOC课程视频")
+	parser.add_argument("terms", nargs="*", type=int, help="学期ID")
+	parser.add_argument("--workers", type=int, default=5, help="同时下载的视频数")
+	parser.add_argument("--retry", type=int, default=3, help="每个视频最多尝试次数")
+	parser.add_argument("--engine", choices=("thread", "async"), default=ENGINE)
+	parser.add_argument("--max-bandwidth", type=int, default=MAX_BANDWIDTH, help="全局带宽上限(字节/秒)")
+	args = parser.parse_args(argv)
+	options = dict(max_workers=args.workers, max_retry=args.retry, engine=args.engine, max_bandwidth=args.max_bandwidth)
+	if len(args.terms) > 1:
+		return batch_download_terms(args.terms, **options)
+	return batch_download_with_retry(load_units(args.terms[0] if args.terms else tid), **options)
 
-# 用法
-batch_download_with_retry(videoids, names, max_workers=5, max_retry=3)
\ No newline at end of file
+if __name__ == "__main__":
+	main()
\ No newline at end of file
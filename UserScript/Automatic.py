@@ -7,6 +7,11 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 import time
 import os
+import sys
+
+# 共用的文本规整在 Scripts/textnorm.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Scripts'))
+from textnorm import DATE_RE, collapse_whitespace, paragraph_breaks, strip_unsafe
 
 
 options = Options()
@@ -131,7 +136,7 @@ def parse_regulation_to_markdown(html_filepath):
     pub_date = metadata.get('公布日期', '')
     date_str = ''
     if pub_date:
-        m = re.search(r'(\d{4})[.\-年](\d{2})[.\-月](\d{2})', pub_date)
+        m = DATE_RE.search(pub_date)
         if m:
             date_str = f"{m.group(1)}-{m.group(2)}-{m.group(3)}"
 
@@ -181,7 +186,7 @@ def parse_regulation_to_markdown(html_filepath):
             elif 'tiao-wrap' in class_list:
                 tiao_span = element.find('span', class_='navtiao')
                 if tiao_span:
-                    tiao_text = re.sub(r'\s+', ' ', tiao_span.get_text(strip=True)).strip()
+                    tiao_text = collapse_whitespace(tiao_span.get_text(strip=True))
                     content_parts.append(f"###### {tiao_text}")
                 
                 # 遍历条文下的每一个“款”(<div class="kuan-wrap">)
@@ -218,10 +223,10 @@ def parse_regulation_to_markdown(html_filepath):
         
     # --- 4. 组合并返回最终结果 (无改动) ---
     # 处理完后，正则将。\n.替换为。\n\n.，实现分段
-    main_content = re.sub(r'。\n(?=.)', '。\n\n', main_content)
+    main_content = paragraph_breaks(main_content)
     final_markdown = f"{yaml_header}\n\n{main_content}"
 
-    safe_title = re.sub(r'[\\/*?:"<>|]', "", final_title)
+    safe_title = strip_unsafe(final_title)
     output_filename = f"./Processor/{safe_title}.md"
     
     # 替换第二个'---'后到第一个'#'之间的内容为\n